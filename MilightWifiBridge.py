@@ -21,6 +21,10 @@
     - Set disco mode (9 available)
     - Increase/Decrease disco mode speed
     - Get Milight wifi bridge MAC address
+    - Discover the wifi bridges of the local network
+    - Same functions as asyncio coroutines, one event loop driving every wifi bridge (AsyncMilightWifiBridge class)
+    - Send requests without waiting for their ACK (animations) and count the late ACKs
+    - Send a batch of commands read from a file or the standard input over one connection (shell)
     - ...
 
   Used protocol: http://www.limitlessled.com/dev/ (LimitlessLED Wifi Bridge v6.0 section)
@@ -34,15 +38,194 @@ __version__ = "1.1 (2019/06/17)"
 __status__ = "Usable for any project"
 
 import socket
+import asyncio
 import collections
+import struct
 import sys, getopt
 import logging
 import binascii
+import threading
+import time
+
+class MilightBridgeLink:
+  """Protocol state of the link with one Milight 3.0 wifi bridge (shared by MilightWifiBridge and
+  AsyncMilightWifiBridge)
+
+  No I/O is made here: the clients take the cached session, the sequence numbers, the time to wait for an
+  answer before sending a frame again (derived from the measured round trip time) and the tokens of the
+  frame rate limiter, and report the answers they receive. The clients serialize the calls (lock of
+  MilightWifiBridge, event loop of AsyncMilightWifiBridge).
+  """
+  # Outcome of the requests sent without waiting for their ACK (see MilightWifiBridge.sendRequests())
+  # Keyword arguments:
+  #   sent -- (int) Requests sent without waiting for their ACK
+  #   acknowledged -- (int) Requests whose ACK was received later
+  #   lost -- (int) Requests not acknowledged in time (or rejected by the wifi bridge)
+  #   pending -- (int) Requests still waiting for their ACK
+  __SEND_STATISTICS = collections.namedtuple("SendStatistics", "sent acknowledged lost pending")
+
+  # Bounds of the time waited for an answer before sending a frame again (adapted to the measured round trip time)
+  __INITIAL_TIMEOUT_SEC = 1.0
+  __MIN_TIMEOUT_SEC = 0.05
+
+  def __init__(self):
+    self.timeout_sec = 5.0
+    self.session_ttl_sec = 60.0
+    self.retransmissions = 3
+    self.setFrameRate(0.0, 5)
+    # Round trip time estimation and statistics are kept when the link is reset
+    self.__srtt = None
+    self.__rttvar = None
+    self.__unacknowledged = {} # Sequence number -> send time, of the requests sent without waiting for their ACK
+    self.__unacknowledged_sent = 0
+    self.__late_acks = 0
+    self.__lost = 0
+    self.reset()
+
+  def configure(self, timeout_sec, session_ttl_sec, retransmissions):
+    """Change the settings given to setup() (see MilightWifiBridge.setup())"""
+    self.timeout_sec = float(timeout_sec)
+    self.session_ttl_sec = float(session_ttl_sec)
+    self.retransmissions = max(0, int(retransmissions))
+
+  def reset(self):
+    """Forget the session and the sequence numbers (the connection was closed)"""
+    self.__sequence_number = 0
+    self.__session = None
+    self.__session_expiration = 0.0
+    # The ACKs still expected can no longer be received
+    self.__lost += len(self.__unacknowledged)
+    self.__unacknowledged.clear()
+
+  def setFrameRate(self, frame_rate, frame_burst=None):
+    """Change the maximum number of frames sent per sec (see MilightWifiBridge.setFrameRate())"""
+    self.__frame_rate = max(0.0, float(frame_rate))
+    if frame_burst is not None:
+      self.__frame_burst = max(1.0, float(frame_burst))
+    self.__tokens = self.__frame_burst
+    self.__tokens_updated = time.monotonic()
+
+  def takeToken(self):
+    """Take a token of the frame rate limiter if there is one
+
+    return: (float) 0 if the frame can be sent now, else time in sec before the next token
+    """
+    if self.__frame_rate <= 0:
+      return 0.0
+    now = time.monotonic()
+    self.__tokens = min(self.__frame_burst, self.__tokens + (now - self.__tokens_updated) * self.__frame_rate)
+    self.__tokens_updated = now
+    if self.__tokens < 1.0:
+      return (1.0 - self.__tokens) / self.__frame_rate
+    self.__tokens -= 1.0
+    return 0.0
+
+  def addRoundTripTimeSample(self, rtt):
+    """Update the round trip time estimation (smoothed RTT and RTT variation, as TCP does in RFC 6298)
+
+    Keyword arguments:
+      rtt -- (float) Round trip time in sec of a frame which was not retransmitted
+    """
+    if self.__srtt is None:
+      self.__srtt = rtt
+      self.__rttvar = rtt / 2.0
+    else:
+      self.__rttvar = 0.75 * self.__rttvar + 0.25 * abs(self.__srtt - rtt)
+      self.__srtt = 0.875 * self.__srtt + 0.125 * rtt
+
+  def getAckTimeout(self):
+    """Give the time in sec to wait for an ACK before sending the request again"""
+    if self.__srtt is None:
+      rto = MilightBridgeLink.__INITIAL_TIMEOUT_SEC
+    else:
+      rto = self.__srtt + 4.0 * self.__rttvar
+    return max(MilightBridgeLink.__MIN_TIMEOUT_SEC, min(rto, self.timeout_sec))
+
+  def getHandshakeTimeout(self):
+    """Give the time in sec to wait for a start session response before sending the request again"""
+    return min(2.0 * self.getAckTimeout(), self.timeout_sec)
+
+  def getRoundTripTime(self):
+    """Give the smoothed round trip time in sec (None if the wifi bridge never answered)"""
+    return self.__srtt
+
+  def getSession(self):
+    """Give the cached session (None if there is none or if it expired)"""
+    if self.__session is not None and time.monotonic() < self.__session_expiration:
+      return self.__session
+    return None
+
+  def setSession(self, response):
+    """Cache the answer to a start session request (the cached session is forgotten if there is no answer)"""
+    if response.responseReceived and self.session_ttl_sec > 0:
+      self.__session = response
+      self.__session_expiration = time.monotonic() + self.session_ttl_sec
+    else:
+      self.__session = None
+
+  def invalidateSession(self):
+    """Forget the cached session so the next request starts a new one"""
+    self.__session = None
+
+  def nextSequenceNumber(self, inFlight):
+    """Give the next sequence number (between 0x01 and 0xFF) not used by a request in flight"""
+    while True:
+      # For each request, increment the sequence number (even if the session ID is regenerated)
+      self.__sequence_number = (self.__sequence_number + 1) & 0xFF
+      if self.__sequence_number != 0 and self.__sequence_number not in inFlight:
+        # An unacknowledged request with the same sequence number can no longer be matched with its ACK
+        if self.__unacknowledged.pop(self.__sequence_number, None) is not None:
+          self.__lost += 1
+        return self.__sequence_number
+
+  def addUnacknowledged(self, sequenceNumber):
+    """Remember a request sent without waiting for its ACK (its late ACK is counted by countLateAck())"""
+    self.__unacknowledged[sequenceNumber] = time.monotonic()
+    self.__unacknowledged_sent += 1
+
+  def hasUnacknowledged(self):
+    """Tell if ACKs of requests sent without waiting for them are still expected"""
+    return len(self.__unacknowledged) > 0
+
+  def countLateAck(self, data):
+    """Count the ACK of a request sent without waiting for it
+
+    return: (bool) ACK of a request sent without waiting for it
+    """
+    if self.__unacknowledged.pop(data[6], None) is None:
+      return False
+    if data[7] == 0x00:
+      self.__late_acks += 1
+    else:
+      # Rejected: the wifi bridge no longer knows the session
+      self.__lost += 1
+      self.__session = None
+    return True
+
+  def expireUnacknowledged(self):
+    """Count as lost the requests sent without waiting for their ACK and not acknowledged within the timeout"""
+    expired = time.monotonic() - self.timeout_sec
+    for sequenceNumber, sentAt in list(self.__unacknowledged.items()):
+      if sentAt < expired:
+        del self.__unacknowledged[sequenceNumber]
+        self.__lost += 1
+
+  def getSendStatistics(self):
+    """Give the outcome of the requests sent without waiting for their ACK
+
+    return: (MilightBridgeLink.__SEND_STATISTICS) Requests sent, acknowledged later, lost and still pending
+    """
+    return MilightBridgeLink.__SEND_STATISTICS(sent=self.__unacknowledged_sent, acknowledged=self.__late_acks,
+                                               lost=self.__lost, pending=len(self.__unacknowledged))
+
 
 class MilightWifiBridge:
   """Milight 3.0 Wifi Bridge class
 
   Calling setup() function is necessary in order to make this class work properly.
+
+  A single instance can be shared by several threads: every exchange with the wifi bridge (session
+  handshake, request and ACK) is serialized so all callers share one socket and one sequence number space.
   """
   ######################### Enums #########################
   class eZone:
@@ -93,6 +276,17 @@ class MilightWifiBridge:
   #   sequenceNumber -- (int) Sequence number
   __START_SESSION_RESPONSE = collections.namedtuple("StartSessionResponse", "responseReceived mac sessionId1 sessionId2")
 
+  # Discovery request broadcast on the local network (UDP port 48899), each wifi bridge answers "ip,MAC,name"
+  __DISCOVERY_MSG = b"HF-A11ASSISTHREAD"
+  __DISCOVERY_PORT = 48899
+
+  # Wifi bridge found on the local network
+  # Keyword arguments:
+  #   ip -- (string) IP address of the wifi bridge
+  #   mac -- (string) MAC address of the wifi bridge (same format as in the start session response)
+  #   name -- (string) Name of the wifi module of the wifi bridge
+  __DISCOVERED_BRIDGE = collections.namedtuple("DiscoveredBridge", "ip mac name")
+
   __ON_CMD = bytearray([0x31, 0x00, 0x00, 0x08, 0x04, 0x01, 0x00, 0x00, 0x00])
   __OFF_CMD = bytearray([0x31, 0x00, 0x00, 0x08, 0x04, 0x02, 0x00, 0x00, 0x00])
   __NIGHT_MODE_CMD = bytearray([0x31, 0x00, 0x00, 0x08, 0x04, 0x05, 0x00, 0x00, 0x00])
@@ -286,157 +480,708 @@ class MilightWifiBridge:
 
     return: (int) Request checksum
     """
-    checkSum = 0
-    for byteCommand in command:
-      checkSum += byteCommand
-    checkSum += zoneId
+    return ((sum(command) + zoneId) & 0xFF)
+
+  # Command of each public function (fixed command or function giving the command from a value)
+  __COMMANDS = {
+    "turnOn": __ON_CMD,
+    "turnOff": __OFF_CMD,
+    "turnOnWifiBridgeLamp": __WIFI_BRIDGE_LAMP_ON_CMD,
+    "turnOffWifiBridgeLamp": __WIFI_BRIDGE_LAMP_OFF_CMD,
+    "setNightMode": __NIGHT_MODE_CMD,
+    "setWhiteMode": __WHITE_MODE_CMD,
+    "setWhiteModeBridgeLamp": __WIFI_BRIDGE_LAMP_WHITE_MODE_CMD,
+    "setDiscoMode": __getSetDiscoModeCmd,
+    "setDiscoModeBridgeLamp": __getSetDiscoModeForBridgeLampCmd,
+    "speedUpDiscoMode": __DISCO_MODE_SPEED_UP_CMD,
+    "speedUpDiscoModeBridgeLamp": __WIFI_BRIDGE_LAMP_DISCO_MODE_SPEED_UP_CMD,
+    "slowDownDiscoMode": __DISCO_MODE_SLOW_DOWN_CMD,
+    "slowDownDiscoModeBridgeLamp": __WIFI_BRIDGE_LAMP_DISCO_MODE_SLOW_DOWN_CMD,
+    "link": __LINK_CMD,
+    "unlink": __UNLINK_CMD,
+    "setColor": __getSetColorCmd,
+    "setColorBridgeLamp": __getSetBridgeLampColorCmd,
+    "setBrightness": __getSetBrightnessCmd,
+    "setBrightnessBridgeLamp": __getSetBrightnessForBridgeLampCmd,
+    "setSaturation": __getSetSaturationCmd,
+    "setTemperature": __getSetTemperatureCmd,
+  }
+
+  # Memoized commands ((action, value) -> command) and checksums (command -> checksum for zones 0 to 4)
+  __COMMAND_TABLE = {}
+  __CHECKSUM_TABLE = {}
+
+  # Request frame: fixed header, then (from byte 5) session ID 1, session ID 2, 0x00, sequence number, 0x00,
+  # command, zone ID, 0x00 and checksum
+  __REQUEST_FRAME_HEADER = bytes([0x80, 0x00, 0x00, 0x00, 0x11])
+  __REQUEST_FRAME = struct.Struct("!BBBBB9sBBB")
+
+  @staticmethod
+  def getCommand(action, value=None):
+    """Give the command sent by a public function
+
+    Commands are built once then memoized, the same (immutable) object is given for the same action and value.
+
+    Keyword arguments:
+      action -- (string) Name of the public function (ex: "turnOn", "setColor", "setBrightnessBridgeLamp")
+      value -- (int, optional) Value of the function (color, brightness, disco mode, ...) if it has one
+
+    return: (bytes) Command
+    """
+    key = (action, value if value is None else int(value))
+    command = MilightWifiBridge.__COMMAND_TABLE.get(key)
+    if command is None:
+      command = MilightWifiBridge.__COMMANDS[action]
+      if isinstance(command, staticmethod):
+        command = command.__func__(value)
+      command = bytes(command)
+      MilightWifiBridge.__COMMAND_TABLE[key] = command
+      MilightWifiBridge.__getCheckSums(command)
+    return command
+
+  @staticmethod
+  def getActions():
+    """Give the actions accepted by getCommand()
+
+    return: (list of string) Name of the public functions sending a command
+    """
+    return list(MilightWifiBridge.__COMMANDS.keys())
+
+  @staticmethod
+  def __getCheckSums(command):
+    """Give the checksums of a command for each zone (memoized for the commands given by getCommand())
+
+    Keyword arguments:
+      command -- (bytes or bytearray) Command
+
+    return: (tuple of int) Request checksum for zone 0 to 4
+    """
+    checkSums = MilightWifiBridge.__CHECKSUM_TABLE.get(command) if isinstance(command, bytes) else None
+    if checkSums is None:
+      checkSums = tuple(MilightWifiBridge.__calculateCheckSum(command, zoneId) for zoneId in range(5))
+      if isinstance(command, bytes):
+        MilightWifiBridge.__CHECKSUM_TABLE[command] = checkSums
+    return checkSums
+
+  @staticmethod
+  def __packRequestFrame(frame, command, zoneId, sessionId1, sessionId2, sequenceNumber):
+    """Write a request in a 22 bytes frame whose header was already written (no allocation)"""
+    MilightWifiBridge.__REQUEST_FRAME.pack_into(frame, 5, sessionId1, sessionId2, 0x00, sequenceNumber, 0x00,
+                                                command, zoneId, 0x00,
+                                                MilightWifiBridge.__getCheckSums(command)[zoneId])
+
+  @staticmethod
+  def getRequestFrame(command, zoneId, sessionId1, sessionId2, sequenceNumber):
+    """Give the frame sending a command to a zone
+
+    Keyword arguments:
+      command -- (bytes or bytearray) Command
+      zoneId -- (int) Zone ID
+      sessionId1 -- (int) First part of the session ID
+      sessionId2 -- (int) Second part of the session ID
+      sequenceNumber -- (int) Sequence number (between 0x01 and 0xFF)
+
+    return: (bytearray) Request frame
+    """
+    frame = bytearray(MilightWifiBridge.__REQUEST_FRAME_HEADER) + bytearray(17)
+    MilightWifiBridge.__packRequestFrame(frame, command, int(zoneId), sessionId1, sessionId2, int(sequenceNumber))
+    return frame
+
+  @staticmethod
+  def getStartSessionRequest():
+    """Give the start session frame
+
+    return: (bytearray) Start session frame
+    """
+    return bytearray(MilightWifiBridge.__START_SESSION_MSG)
 
-    return (checkSum & 0xFF)
+  @staticmethod
+  def parseStartSessionResponse(data):
+    """Parse the wifi bridge response to a start session frame
+
+    Keyword arguments:
+      data -- (bytes) Frame received from the wifi bridge
+
+    return: (MilightWifiBridge.__START_SESSION_RESPONSE) Start session information (responseReceived is False
+                                                         if the frame is not a start session response)
+    """
+    if len(data) != 22:
+      return MilightWifiBridge.__START_SESSION_RESPONSE(responseReceived=False, mac="", sessionId1=-1, sessionId2=-1)
+
+    return MilightWifiBridge.__START_SESSION_RESPONSE(responseReceived=True,
+                                                      mac=str("{}:{}:{}:{}:{}:{}".format(format(data[7], 'x'),
+                                                                                         format(data[8], 'x'),
+                                                                                         format(data[9], 'x'),
+                                                                                         format(data[10], 'x'),
+                                                                                         format(data[11], 'x'),
+                                                                                         format(data[12], 'x'))),
+                                                      sessionId1=int(data[19]),
+                                                      sessionId2=int(data[20]))
+
+  @staticmethod
+  def parseDiscoveryResponse(data):
+    """Parse the wifi bridge response to a discovery request
+
+    Keyword arguments:
+      data -- (bytes) Datagram received on the discovery socket
+
+    return: (MilightWifiBridge.__DISCOVERED_BRIDGE) Wifi bridge information (None if the datagram is not a
+                                                    discovery response)
+    """
+    try:
+      fields = data.decode("ascii").strip().split(",")
+    except UnicodeDecodeError:
+      return None
+    if len(fields) < 2 or len(fields[1]) != 12:
+      return None
+    try:
+      mac = ":".join(format(int(fields[1][i:i+2], 16), 'x') for i in range(0, 12, 2))
+      socket.inet_aton(fields[0])
+    except (ValueError, socket.error):
+      return None
+    return MilightWifiBridge.__DISCOVERED_BRIDGE(ip=fields[0], mac=mac, name=",".join(fields[2:]))
+
+  @staticmethod
+  def discoverBridges(timeout_sec=2.0, address="255.255.255.255", port=None):
+    """Find the wifi bridges of the local network
+
+    The discovery request is broadcast (sent again halfway through in case it was lost) and the answers
+    are collected until the timeout.
+
+    Keyword arguments:
+      timeout_sec -- (float, optional) Time to wait for the answers
+      address -- (string, optional) Broadcast address (or address of one wifi bridge)
+      port -- (int, optional) Discovery port of the wifi bridges (default: 48899)
+
+    return: (list of MilightWifiBridge.__DISCOVERED_BRIDGE) Wifi bridges found (in order of answer)
+    """
+    if port is None:
+      port = MilightWifiBridge.__DISCOVERY_PORT
+    bridges = collections.OrderedDict()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+      sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+      start = time.monotonic()
+      requests = [start, start + timeout_sec / 2.0]
+      while True:
+        now = time.monotonic()
+        if now >= start + timeout_sec:
+          break
+        if len(requests) > 0 and now >= requests[0]:
+          requests.pop(0)
+          logging.debug("Sending discovery request to {}:{}".format(str(address), str(port)))
+          sock.sendto(MilightWifiBridge.__DISCOVERY_MSG, (address, port))
+        wakeUp = start + timeout_sec
+        if len(requests) > 0:
+          wakeUp = min(wakeUp, requests[0])
+        sock.settimeout(max(0.001, wakeUp - now))
+        try:
+          data = sock.recvfrom(1024)[0]
+        except socket.timeout:
+          continue
+        bridge = MilightWifiBridge.parseDiscoveryResponse(data)
+        if bridge is None:
+          logging.debug("Ignoring discovery answer {}".format(str(data)))
+        elif bridge.mac not in bridges:
+          logging.debug("Discovered wifi bridge {} (MAC address {})".format(bridge.ip, bridge.mac))
+          bridges[bridge.mac] = bridge
+    except socket.error as err:
+      logging.error("Discovery failed: {}".format(str(err)))
+    finally:
+      sock.close()
+    return list(bridges.values())
 
 
   ################################### INIT ####################################
   def __init__(self):
     """Class must be initialized with setup()"""
+    self.__lock = threading.RLock()
+    # Round trip time estimation and statistics are kept when setup() is called again
+    self.__link = MilightBridgeLink()
     self.close()
 
 
   ################################### SETUP ####################################
   def close(self):
     """Close connection with Milight wifi bridge"""
-    self.__initialized = False
-    self.__sequence_number = 0
+    with self.__lock:
+      self.__initialized = False
+      self.__link.reset()
+
+      try:
+        self.__sock.shutdown(socket.SHUT_RDWR)
+        self.__sock.close()
+        logging.debug("Socket closed")
+      # If close before initialization, better handle attribute error
+      #except AttributeError:
+      except:
+        pass
+
+  def setup(self, ip, port=5987, timeout_sec=5.0, session_ttl_sec=60.0, pipeline_window=16, retransmissions=3,
+            wait_ack=True, frame_rate=0.0, frame_burst=5):
+    """Initialize the class (can be launched multiple time if setup changed or module crashed)
 
-    try:
-      self.__sock.shutdown(socket.SHUT_RDWR)
-      self.__sock.close()
-      logging.debug("Socket closed")
-    # If close before initialization, better handle attribute error
-    #except AttributeError:
-    except:
-      pass
+    Frames not answered in time (the deadline is derived from the measured round trip time) are sent
+    again as they are, a request only fails once it was not acknowledged after 'retransmissions'
+    retransmissions or after timeout_sec.
 
-  def setup(self, ip, port=5987, timeout_sec=5.0):
-    """Initialize the class (can be launched multiple time if setup changed or module crashed)
+    A host name is resolved here, once: the UDP socket is connected to the resolved address so no
+    lookup is made per frame and datagrams from other hosts are not received. Call setup() again to
+    resolve it again (ex: after a failure).
+
+    The wifi bridge silently drops the frames it receives too fast: with a frame rate, every frame sent
+    (retransmissions and start session requests included) waits for a token of a token bucket refilled
+    at frame_rate tokens per sec and holding up to frame_burst tokens (see calibrateFrameRate()).
 
     Keyword arguments:
-      ip -- (string) IP to communication with the Milight wifi bridge
+      ip -- (string) IP (or host name) to communication with the Milight wifi bridge
       port -- (int, optional) UDP port to communication with the Milight wifi bridge
-      timeout_sec -- (int, optional) Timeout in sec for Milight wifi bridge to answer commands
+      timeout_sec -- (int, optional) Maximum time in sec for Milight wifi bridge to answer commands
+      session_ttl_sec -- (float, optional) Time in sec a session is reused before a new start session
+                                           request is sent (0 to start a new session for each request)
+      pipeline_window -- (int, optional) Default maximum number of requests in flight for sendRequests()
+      retransmissions -- (int, optional) Number of times an unanswered frame is sent again
+      wait_ack -- (bool, optional) Wait for the ACK of the requests (False: send the requests and return
+                                   immediately, see sendRequests())
+      frame_rate -- (float, optional) Maximum number of frames sent per sec (0 for no limit)
+      frame_burst -- (int, optional) Number of frames that can be sent at once before frame_rate applies
 
     return: (bool) Milight wifi bridge initialized
     """
-    # Close potential previous Milight wifi bridge session
-    self.close()
-
-    # Create new milight wifi bridge session
-    try:
-      self.__sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM) # UDP
-      self.__sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
-      self.__ip = ip
-      self.__port = port
-      #self.__sock.connect((self.__ip, self.__port))
-      self.__sock.settimeout(timeout_sec)
-      self.__initialized = True
-      logging.debug("UDP connection initialized with ip {} and port {}".format(str(ip), str(port)))
-    except (socket.error, socket.herror, socket.gaierror, socket.timeout) as err:
-      logging.error("Impossible to initialize the UDP connection with ip {} and port {}: {}".format(str(ip), str(port), str(err)))
+    with self.__lock:
+      # Close potential previous Milight wifi bridge session
+      self.close()
+
+      # Create new milight wifi bridge session
+      try:
+        self.__sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM) # UDP
+        self.__sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.__ip = ip
+        self.__port = port
+        self.__address = socket.getaddrinfo(ip, port, socket.AF_INET, socket.SOCK_DGRAM)[0][4]
+        self.__frame = bytearray(MilightWifiBridge.__REQUEST_FRAME_HEADER) + bytearray(17)
+        self.__link.configure(timeout_sec, session_ttl_sec, retransmissions)
+        self.__pipeline_window = int(pipeline_window)
+        self.__wait_ack = bool(wait_ack)
+        self.setFrameRate(frame_rate, frame_burst)
+        self.__sock.connect(self.__address)
+        self.__sock.settimeout(timeout_sec)
+        self.__initialized = True
+        logging.debug("UDP connection initialized with ip {} ({}) and port {}".format(str(ip), str(self.__address[0]),
+                                                                                      str(port)))
+      except (socket.error, socket.herror, socket.gaierror, socket.timeout) as err:
+        logging.error("Impossible to initialize the UDP connection with ip {} and port {}: {}".format(str(ip), str(port), str(err)))
+
+      return self.__initialized
+
+  def isInitialized(self):
+    """Tell if setup() succeeded and close() was not called since
 
+    return: (bool) Milight wifi bridge initialized
+    """
     return self.__initialized
 
+  def setFrameRate(self, frame_rate, frame_burst=None):
+    """Change the maximum number of frames sent per sec (see setup())
+
+    Keyword arguments:
+      frame_rate -- (float) Maximum number of frames sent per sec (0 for no limit)
+      frame_burst -- (int, optional) Number of frames that can be sent at once (default: unchanged)
+    """
+    with self.__lock:
+      self.__link.setFrameRate(frame_rate, frame_burst)
+
 
   ######################### INTERNAL UTILITY FUNCTIONS #########################
-  def __startSession(self):
+  def __waitToken(self):
+    """Wait until the frame rate limiter allows sending a frame"""
+    delay = self.__link.takeToken()
+    while delay > 0:
+      time.sleep(delay)
+      delay = self.__link.takeToken()
+
+  def __startSession(self, timeout_sec=None):
     """Send start session request and return start session information
 
+    The start session frame is sent again if the wifi bridge does not answer before the handshake
+    deadline (see MilightBridgeLink.getHandshakeTimeout()), up to the number of retransmissions given to setup().
+
+    Keyword arguments:
+      timeout_sec -- (float, optional) Maximum time to wait for the wifi bridge (default: timeout given to setup())
+
     return: (MilightWifiBridge.__START_SESSION_RESPONSE) Start session information containing response received,
                                                          mac address and session IDs
     """
-    # Send start session request
     data_to_send = MilightWifiBridge.__START_SESSION_MSG
-    logging.debug("Sending frame '{}' to {}:{}".format(str(binascii.hexlify(data_to_send)),
-                                                     str(self.__ip), str(self.__port)))
-    self.__sock.sendto(data_to_send, (self.__ip, self.__port))
     response = MilightWifiBridge.__START_SESSION_RESPONSE(responseReceived=False, mac="", sessionId1=-1, sessionId2=-1)
+    if timeout_sec is None or timeout_sec > self.__link.timeout_sec:
+      timeout_sec = self.__link.timeout_sec
+    giveUp = time.monotonic() + timeout_sec
 
     try:
-      # Receive start session response
-      data = self.__sock.recvfrom(1024)[0]
-      if len(data) == 22:
-        # Parse valid start session response
-        response = MilightWifiBridge.__START_SESSION_RESPONSE(responseReceived=True,
-                                                              mac=str("{}:{}:{}:{}:{}:{}".format(format(data[7], 'x'),
-                                                                                                 format(data[8], 'x'),
-                                                                                                 format(data[9], 'x'),
-                                                                                                 format(data[10], 'x'),
-                                                                                                 format(data[11], 'x'),
-                                                                                                 format(data[12], 'x'))),
-                                                              sessionId1=int(data[19]),
-                                                              sessionId2=int(data[20]))
-        logging.debug("Start session (mac address: {}, session ID 1: {}, session ID 2: {})"
-                      .format(str(response.mac), str(response.sessionId1), str(response.sessionId2)))
-      else:
-        logging.warning("Invalid start session response size")
-    except socket.timeout:
+      for attempt in range(self.__link.retransmissions + 1):
+        # Send start session request
+        logging.debug("Sending frame '{}' to {}:{}".format(str(binascii.hexlify(data_to_send)),
+                                                         str(self.__ip), str(self.__port)))
+        self.__waitToken()
+        sentAt = time.monotonic()
+        self.__sock.send(data_to_send)
+        deadline = min(giveUp, sentAt + self.__link.getHandshakeTimeout() * (2 ** attempt))
+
+        # Receive start session response (count the late ACKs of the requests sent without waiting for them)
+        while not response.responseReceived and time.monotonic() < deadline:
+          self.__sock.settimeout(max(0.001, deadline - time.monotonic()))
+          try:
+            data = self.__sock.recv(1024)
+          except socket.timeout:
+            break
+          if len(data) == 22:
+            # Parse valid start session response
+            response = MilightWifiBridge.parseStartSessionResponse(data)
+            if attempt == 0:
+              self.__link.addRoundTripTimeSample(time.monotonic() - sentAt)
+            logging.debug("Start session (mac address: {}, session ID 1: {}, session ID 2: {})"
+                          .format(str(response.mac), str(response.sessionId1), str(response.sessionId2)))
+          elif len(data) != 8 or not self.__link.countLateAck(data):
+            logging.debug("Ignoring frame of size {} while waiting for start session response".format(str(len(data))))
+
+        if response.responseReceived or time.monotonic() >= giveUp:
+          break
+        logging.info("No start session response, sending start session request again")
+    except socket.error as err:
+      # Ex: ICMP port unreachable reported on the connected socket
+      logging.warning("Start session failed: {}".format(str(err)))
+    finally:
+      self.__sock.settimeout(self.__link.timeout_sec)
+
+    if not response.responseReceived:
       logging.warning("Timed out for start session response")
+    return response
+
+  def getRoundTripTime(self):
+    """Give the smoothed round trip time with the wifi bridge
+
+    return: (float) Smoothed round trip time in sec (None if the wifi bridge never answered)
+    """
+    return self.__link.getRoundTripTime()
+
+  def __getSession(self, timeout_sec=None):
+    """Give the cached session, start a new one if there is none or if it expired
 
+    Keyword arguments:
+      timeout_sec -- (float, optional) Maximum time to wait for a new session (see __startSession())
+
+    return: (MilightWifiBridge.__START_SESSION_RESPONSE) Start session information (see __startSession())
+    """
+    session = self.__link.getSession()
+    if session is not None:
+      return session
+
+    response = self.__startSession(timeout_sec)
+    self.__link.setSession(response)
     return response
 
+  def invalidateSession(self):
+    """Forget the cached session so the next request starts a new one"""
+    with self.__lock:
+      self.__link.invalidateSession()
+
+  def ping(self, timeout_sec=None, fresh=False):
+    """Check the wifi bridge answers a start session request on the current socket (the session is cached)
+
+    A cached session that did not expire already tells the wifi bridge answered, it is kept unless fresh.
+
+    Keyword arguments:
+      timeout_sec -- (float, optional) Maximum time to wait for the wifi bridge (default: timeout given to setup())
+      fresh -- (bool, optional) Start a new session even if a cached one did not expire
+
+    return: (bool) Wifi bridge answered
+    """
+    with self.__lock:
+      if not self.__initialized:
+        return False
+      if fresh:
+        self.__link.invalidateSession()
+      returnValue = self.__getSession(timeout_sec).responseReceived
+    logging.debug("Ping: {}".format(str(returnValue)))
+    return returnValue
+
+  def calibrateFrameRate(self, start_rate=10.0, max_rate=200.0, burst_sec=1.0, step=1.5, margin=0.9):
+    """Measure the highest frame rate the wifi bridge answers without loss
+
+    Bursts of start session requests (they change nothing on the lights) are sent at an increasing rate
+    until one of them is not fully answered. Each burst lasts burst_sec so the buffers of the wifi bridge
+    cannot hide its real capacity. The frame rate limiter is not used while calibrating and is left
+    unchanged (see setFrameRate()).
+
+    Keyword arguments:
+      start_rate -- (float, optional) First frame rate tried (frames per sec)
+      max_rate -- (float, optional) Highest frame rate tried (frames per sec)
+      burst_sec -- (float, optional) Duration in sec of the burst sent at each rate
+      step -- (float, optional) Factor applied to the frame rate after a burst without loss
+      margin -- (float, optional) Factor applied to the highest frame rate without loss to stay under it
+
+    return: (float) Frame rate to use (0 if frames were lost at start_rate)
+    """
+    best = 0.0
+    rate = float(start_rate)
+    with self.__lock:
+      if not self.__initialized:
+        return best
+      # The wifi bridge may give new session IDs, the handshake also measures the round trip time
+      self.__link.invalidateSession()
+      if not self.__startSession().responseReceived:
+        return best
+      try:
+        while rate <= max_rate:
+          frames = max(2, int(round(rate * burst_sec)))
+          answers = self.__sendCalibrationBurst(rate, frames)
+          logging.debug("Calibration: {} of {} frames answered at {:.1f} frames per sec".format(str(answers),
+                                                                                             str(frames), rate))
+          if answers < frames:
+            break
+          best = rate
+          rate *= step
+      except socket.error as err:
+        logging.warning("Calibration failed: {}".format(str(err)))
+      finally:
+        self.__sock.settimeout(self.__link.timeout_sec)
+    logging.debug("Highest frame rate without loss: {:.1f} frames per sec".format(best))
+    return best * margin
+
+  def __sendCalibrationBurst(self, rate, frames):
+    """Send start session requests at rate frames per sec and give the number of answers received"""
+    answers = 0
+    sent = 0
+    start = time.monotonic()
+    end = start + (frames - 1) / rate + self.__link.getHandshakeTimeout()
+    while True:
+      now = time.monotonic()
+      if sent < frames and now >= start + sent / rate:
+        self.__sock.send(MilightWifiBridge.__START_SESSION_MSG)
+        sent += 1
+        continue
+      if sent == frames and now >= end:
+        return min(answers, frames)
+      self.__sock.settimeout(max(0.001, (end if sent == frames else start + sent / rate) - now))
+      try:
+        data = self.__sock.recv(1024)
+      except socket.timeout:
+        continue
+      if len(data) == 22:
+        answers += 1
+
   def __sendRequest(self, command, zoneId):
     """Send command to a specific zone and get response (ACK from the wifi bridge)
 
     Keyword arguments:
-      command -- (bytearray) Command
+      command -- (bytes) Command
       zoneId -- (int) Zone ID
 
     return: (bool) Request received by the wifi bridge
     """
-    returnValue = False
+    return self.sendRequests([(command, zoneId)], window=1)[0]
+
+  def __collectLateAcks(self):
+    """Read the ACKs already received (without waiting) of the requests sent without waiting for them"""
+    try:
+      self.__sock.settimeout(0.0)
+      while self.__link.hasUnacknowledged():
+        data = self.__sock.recv(64)
+        if len(data) != 8 or not self.__link.countLateAck(data):
+          logging.debug("Ignoring frame of size {} (not waiting for it)".format(str(len(data))))
+    except socket.error:
+      # Nothing more to read (or ICMP error, the requests will time out)
+      pass
+    finally:
+      self.__sock.settimeout(self.__link.timeout_sec)
+
+    self.__link.expireUnacknowledged()
+
+  def getSendStatistics(self):
+    """Give the outcome of the requests sent without waiting for their ACK (since the instance was created)
+
+    return: (SendStatistics) Requests sent, acknowledged later, lost and still pending (see MilightBridgeLink)
+    """
+    with self.__lock:
+      if self.__initialized and self.__link.hasUnacknowledged():
+        self.__collectLateAcks()
+      return self.__link.getSendStatistics()
+
+  def sendRequests(self, requests, window=None, waitAck=None, onAck=None):
+    """Send several commands without waiting for the ACK of a command before sending the next one
+
+    Up to 'window' requests are in flight at the same time on the same session, each ACK received is
+    matched with its request using the sequence number.
+
+    Without waiting for the ACKs, every request is sent once and the function returns immediately (for
+    animations: the next frame supersedes the last one anyway). Their ACKs are counted when they are read
+    by a later call (see getSendStatistics()).
+
+    Keyword arguments:
+      requests -- (list of (bytes, int)) Commands (see getCommand()) and zone ID they must be sent to
+      window -- (int, optional) Maximum number of requests waiting for their ACK (between 1 and 255,
+                                default value given to setup())
+      waitAck -- (bool, optional) Wait for the ACK of the requests (default value given to setup())
+      onAck -- (function, optional) Called with (request index, time in sec since the request was first sent)
+                                    as soon as a request is acknowledged
+
+    return: (list of bool) Request received by the wifi bridge (request sent if not waiting for the ACKs),
+                           for each request
+    """
+    returnValues = [False] * len(requests)
+    if window is None:
+      window = self.__pipeline_window
+    window = max(1, min(int(window), 255))
+    if waitAck is None:
+      waitAck = self.__wait_ack
 
     # Send request only if valid parameters
-    if len(bytearray(command)) == 9:
-      if int(zoneId) >= 0 and int(zoneId) <= 4:
-        startSessionResponse = self.__startSession()
-        if startSessionResponse.responseReceived:
-          # For each request, increment the sequence number (even if the session ID is regenerated)
-          # Sequence number must be between 0x01 and 0xFF
-          self.__sequence_number = (self.__sequence_number + 1) & 0xFF
-          if self.__sequence_number == 0:
-            self.__sequence_number = 1
-
-          # Prepare request frame to send
-          bytesToSend = bytearray([0x80, 0x00, 0x00, 0x00, 0x11, startSessionResponse.sessionId1,
-                                   startSessionResponse.sessionId2, 0x00, int(self.__sequence_number), 0x00])
-          bytesToSend += bytearray(command)
-          bytesToSend += bytearray([int(zoneId), 0x00])
-          bytesToSend += bytearray([int(MilightWifiBridge.__calculateCheckSum(bytearray(command), int(zoneId)))])
-
-          # Send request frame
-          logging.debug("Sending request with command '{}' with session ID 1 '{}', session ID 2 '{}' and sequence number '{}'"
-                        .format(str(binascii.hexlify(command)), str(startSessionResponse.sessionId1),
-                                str(startSessionResponse.sessionId2), str(self.__sequence_number)))
-          self.__sock.sendto(bytesToSend, (self.__ip, self.__port))
+    toSend = []
+    for index, (command, zoneId) in enumerate(requests):
+      if len(command) != 9:
+        logging.error("Invalid command size {} instead of 9".format(str(len(command))))
+      elif int(zoneId) < 0 or int(zoneId) > 4:
+        logging.error("Invalid zone {} (must be between 0 and 4)".format(str(zoneId)))
+      else:
+        toSend.append(index)
+    if len(toSend) == 0:
+      return returnValues
+
+    # Session handshake, requests and ACKs must not interleave with another thread using the same socket
+    with self.__lock:
+      if self.__link.hasUnacknowledged():
+        self.__collectLateAcks()
+      reusedSession = self.__link.getSession() is not None
+      startSessionResponse = self.__getSession()
+      if not startSessionResponse.responseReceived:
+        logging.warning("Start session failed")
+        return returnValues
+
+      if not waitAck:
+        return self.__sendUnacknowledged(requests, toSend, startSessionResponse, returnValues)
+
+      rejected = []
+      inFlight = {} # Sequence number -> [request index, send time, ACK deadline, retransmissions, give up time]
+      nextToSend = 0
+      frame = self.__frame
+      sessionId1 = startSessionResponse.sessionId1
+      sessionId2 = startSessionResponse.sessionId2
+      debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+      try:
+        while nextToSend < len(toSend) or len(inFlight) > 0:
+          # Fill the window (as fast as the frame rate allows)
+          tokenDelay = 0.0
+          while nextToSend < len(toSend) and len(inFlight) < window:
+            tokenDelay = self.__link.takeToken()
+            if tokenDelay > 0:
+              break
+            index = toSend[nextToSend]
+            command, zoneId = requests[index]
+            sequenceNumber = self.__link.nextSequenceNumber(inFlight)
+            MilightWifiBridge.__packRequestFrame(frame, command, zoneId, sessionId1, sessionId2, sequenceNumber)
+            if debug:
+              logging.debug("Sending request with command '{}' with session ID 1 '{}', session ID 2 '{}' and sequence number '{}'"
+                            .format(str(binascii.hexlify(command)), str(sessionId1), str(sessionId2), str(sequenceNumber)))
+            now = time.monotonic()
+            self.__sock.send(frame)
+            inFlight[sequenceNumber] = [index, now, now + self.__link.getAckTimeout(), 0, now + self.__link.timeout_sec]
+            nextToSend += 1
+
+          # Send again (same frame and sequence number) the requests not acknowledged in time, give up after
+          # the last retransmission
+          now = time.monotonic()
+          for sequenceNumber, request in list(inFlight.items()):
+            if request[2] > now:
+              continue
+            if request[3] >= self.__link.retransmissions or request[4] <= now:
+              logging.warning("Timed out for response to sequence number {}".format(str(sequenceNumber)))
+              del inFlight[sequenceNumber]
+              continue
+            tokenDelay = self.__link.takeToken()
+            if tokenDelay > 0:
+              break
+            request[3] += 1
+            logging.info("No response to sequence number {}, sending it again (retransmission {})"
+                         .format(str(sequenceNumber), str(request[3])))
+            command, zoneId = requests[request[0]]
+            MilightWifiBridge.__packRequestFrame(frame, command, zoneId, sessionId1, sessionId2, sequenceNumber)
+            self.__sock.send(frame)
+            request[2] = min(request[4], now + self.__link.getAckTimeout() * (2 ** request[3]))
+          if len(inFlight) == 0:
+            if tokenDelay > 0:
+              time.sleep(tokenDelay)
+            continue
+
+          # Receive response frame (until the next retransmission or token)
+          wakeUp = min(request[2] for request in inFlight.values())
+          if tokenDelay > 0:
+            # A retransmission waiting for a token is sent once the token is there
+            wakeUp = now + tokenDelay if wakeUp <= now else min(wakeUp, now + tokenDelay)
+          self.__sock.settimeout(max(0.001, wakeUp - now))
           try:
-            # Receive response frame
-            data = self.__sock.recvfrom(64)[0]
-            if len(data) == 8:
-              if data[6] == self.__sequence_number:
-                returnValue = True
-                logging.debug("Received valid response for previously sent request")
-              else:
-                logging.warning("Invalid sequence number ack {} instead of {}".format(str(data[6]),
-                                                                                      self.__sequence_number))
-            else:
-              logging.warning("Invalid response size {} instead of 8".format(str(len(data))))
+            data = self.__sock.recv(64)
           except socket.timeout:
-            logging.warning("Timed out for response")
-        else:
-          logging.warning("Start session failed")
-      else:
-        logging.error("Invalid zone {} (must be between 0 and 4)".format(str(zoneId)))
-    else:
-      logging.error("Invalid command size {} instead of 9".format(str(len(bytearray(command)))))
-
-    return returnValue
+            continue
+          if len(data) != 8:
+            logging.warning("Invalid response size {} instead of 8".format(str(len(data))))
+          elif data[6] not in inFlight:
+            if self.__link.countLateAck(data):
+              continue
+            logging.debug("Ignoring ack of sequence number {} (not waiting for it)".format(str(data[6])))
+          else:
+            request = inFlight.pop(data[6])
+            # Only frames sent once give a reliable round trip time (Karn's algorithm)
+            if request[3] == 0:
+              self.__link.addRoundTripTimeSample(time.monotonic() - request[1])
+            if data[7] == 0x00:
+              returnValues[request[0]] = True
+              logging.debug("Received valid response for request with sequence number {}".format(str(data[6])))
+              if onAck is not None:
+                onAck(request[0], time.monotonic() - request[1])
+            else:
+              rejected.append(request[0])
+      except socket.error as err:
+        # Ex: ICMP port unreachable reported on the connected socket, the requests in flight failed
+        logging.warning("Requests failed: {}".format(str(err)))
+      finally:
+        self.__sock.settimeout(self.__link.timeout_sec)
+
+      if len(rejected) > 0 and reusedSession:
+        # The wifi bridge no longer knows the cached session: start a new one and send again
+        logging.info("Session rejected by the wifi bridge, starting a new session")
+        self.__link.invalidateSession()
+        retried = self.sendRequests([requests[index] for index in rejected], window, waitAck=True,
+                                    onAck=None if onAck is None else lambda index, elapsed: onAck(rejected[index], elapsed))
+        for index, returnValue in zip(rejected, retried):
+          returnValues[index] = returnValue
+      elif len(rejected) > 0:
+        logging.warning("{} request(s) rejected by the wifi bridge".format(str(len(rejected))))
+
+      # Do not trust the cached session anymore if the wifi bridge did not acknowledge every request
+      if not all(returnValues[index] for index in toSend):
+        self.__link.invalidateSession()
+
+    return returnValues
+
+  def __sendUnacknowledged(self, requests, toSend, startSessionResponse, returnValues):
+    """Send requests once without waiting for their ACK, their sequence number is kept to count the late ACKs"""
+    frame = self.__frame
+    try:
+      for index in toSend:
+        command, zoneId = requests[index]
+        sequenceNumber = self.__link.nextSequenceNumber(())
+        MilightWifiBridge.__packRequestFrame(frame, command, zoneId, startSessionResponse.sessionId1,
+                                             startSessionResponse.sessionId2, sequenceNumber)
+        self.__waitToken()
+        self.__sock.send(frame)
+        self.__link.addUnacknowledged(sequenceNumber)
+        returnValues[index] = True
+    except socket.error as err:
+      logging.warning("Requests failed: {}".format(str(err)))
+      self.__link.invalidateSession()
+    logging.debug("Sent {} request(s) without waiting for their ACK".format(str(sum(returnValues))))
+    return returnValues
 
 
   ######################### PUBLIC FUNCTIONS #########################
@@ -448,7 +1193,7 @@ class MilightWifiBridge:
 
     return: (bool) Request received by the wifi bridge
     """
-    returnValue = self.__sendRequest(MilightWifiBridge.__ON_CMD, zoneId)
+    returnValue = self.__sendRequest(MilightWifiBridge.getCommand("turnOn"), zoneId)
     logging.debug("Turn on zone {}: {}".format(str(zoneId), str(returnValue)))
     return returnValue
 
@@ -460,7 +1205,7 @@ class MilightWifiBridge:
 
     return: (bool) Request received by the wifi bridge
     """
-    returnValue = self.__sendRequest(MilightWifiBridge.__OFF_CMD, zoneId)
+    returnValue = self.__sendRequest(MilightWifiBridge.getCommand("turnOff"), zoneId)
     logging.debug("Turn off zone {}: {}".format(str(zoneId), str(returnValue)))
     return returnValue
 
@@ -469,7 +1214,7 @@ class MilightWifiBridge:
 
     return: (bool) Request received by the wifi bridge
     """
-    returnValue = self.__sendRequest(MilightWifiBridge.__WIFI_BRIDGE_LAMP_ON_CMD, 0x01)
+    returnValue = self.__sendRequest(MilightWifiBridge.getCommand("turnOnWifiBridgeLamp"), 0x01)
     logging.debug("Turn on wifi bridge lamp: {}".format(str(returnValue)))
     return returnValue
 
@@ -478,7 +1223,7 @@ class MilightWifiBridge:
 
     return: (bool) Request received by the wifi bridge
     """
-    returnValue = self.__sendRequest(MilightWifiBridge.__WIFI_BRIDGE_LAMP_OFF_CMD, 0x01)
+    returnValue = self.__sendRequest(MilightWifiBridge.getCommand("turnOffWifiBridgeLamp"), 0x01)
     logging.debug("Turn off wifi bridge lamp: {}".format(str(returnValue)))
     return returnValue
 
@@ -490,7 +1235,7 @@ class MilightWifiBridge:
 
     return: (bool) Request received by the wifi bridge
     """
-    returnValue = self.__sendRequest(MilightWifiBridge.__NIGHT_MODE_CMD, zoneId)
+    returnValue = self.__sendRequest(MilightWifiBridge.getCommand("setNightMode"), zoneId)
     logging.debug("Set night mode to zone {}: {}".format(str(zoneId), str(returnValue)))
     return returnValue
 
@@ -502,7 +1247,7 @@ class MilightWifiBridge:
 
     return: (bool) Request received by the wifi bridge
     """
-    returnValue = self.__sendRequest(MilightWifiBridge.__WHITE_MODE_CMD, zoneId)
+    returnValue = self.__sendRequest(MilightWifiBridge.getCommand("setWhiteMode"), zoneId)
     logging.debug("Set white mode to zone {}: {}".format(str(zoneId), str(returnValue)))
     return returnValue
 
@@ -511,7 +1256,7 @@ class MilightWifiBridge:
 
     return: (bool) Request received by the wifi bridge
     """
-    returnValue = self.__sendRequest(MilightWifiBridge.__WIFI_BRIDGE_LAMP_WHITE_MODE_CMD, 0x01)
+    returnValue = self.__sendRequest(MilightWifiBridge.getCommand("setWhiteModeBridgeLamp"), 0x01)
     logging.debug("Set white mode to wifi bridge: {}".format(str(returnValue)))
     return returnValue
 
@@ -524,7 +1269,7 @@ class MilightWifiBridge:
 
     return: (bool) Request received by the wifi bridge
     """
-    returnValue = self.__sendRequest(MilightWifiBridge.__getSetDiscoModeCmd(discoMode), zoneId)
+    returnValue = self.__sendRequest(MilightWifiBridge.getCommand("setDiscoMode", discoMode), zoneId)
     logging.debug("Set disco mode {} to zone {}: {}".format(str(discoMode), str(zoneId), str(returnValue)))
     return returnValue
 
@@ -536,7 +1281,7 @@ class MilightWifiBridge:
 
     return: (bool) Request received by the wifi bridge
     """
-    returnValue = self.__sendRequest(MilightWifiBridge.__getSetDiscoModeForBridgeLampCmd(discoMode), 0x01)
+    returnValue = self.__sendRequest(MilightWifiBridge.getCommand("setDiscoModeBridgeLamp", discoMode), 0x01)
     logging.debug("Set disco mode {} to wifi bridge: {}".format(str(discoMode), str(returnValue)))
     return returnValue
 
@@ -548,7 +1293,7 @@ class MilightWifiBridge:
 
     return: (bool) Request received by the wifi bridge
     """
-    returnValue = self.__sendRequest(MilightWifiBridge.__DISCO_MODE_SPEED_UP_CMD, zoneId)
+    returnValue = self.__sendRequest(MilightWifiBridge.getCommand("speedUpDiscoMode"), zoneId)
     logging.debug("Speed up disco mode to zone {}: {}".format(str(zoneId), str(returnValue)))
     return returnValue
 
@@ -557,7 +1302,7 @@ class MilightWifiBridge:
 
     return: (bool) Request received by the wifi bridge
     """
-    returnValue = self.__sendRequest(MilightWifiBridge.__WIFI_BRIDGE_LAMP_DISCO_MODE_SPEED_UP_CMD, 0x01)
+    returnValue = self.__sendRequest(MilightWifiBridge.getCommand("speedUpDiscoModeBridgeLamp"), 0x01)
     logging.debug("Speed up disco mode to wifi bridge: {}".format(str(returnValue)))
     return returnValue
 
@@ -569,7 +1314,7 @@ class MilightWifiBridge:
 
     return: (bool) Request received by the wifi bridge
     """
-    returnValue = self.__sendRequest(MilightWifiBridge.__DISCO_MODE_SLOW_DOWN_CMD, zoneId)
+    returnValue = self.__sendRequest(MilightWifiBridge.getCommand("slowDownDiscoMode"), zoneId)
     logging.debug("Slow down disco mode to zone {}: {}".format(str(zoneId), str(returnValue)))
     return returnValue
 
@@ -581,7 +1326,7 @@ class MilightWifiBridge:
 
     return: (bool) Request received by the wifi bridge
     """
-    returnValue = self.__sendRequest(MilightWifiBridge.__WIFI_BRIDGE_LAMP_DISCO_MODE_SLOW_DOWN_CMD, 0x01)
+    returnValue = self.__sendRequest(MilightWifiBridge.getCommand("slowDownDiscoModeBridgeLamp"), 0x01)
     logging.debug("Slow down disco mode to wifi bridge: {}".format(str(returnValue)))
     return returnValue
 
@@ -593,7 +1338,7 @@ class MilightWifiBridge:
 
     return: (bool) Request received by the wifi bridge
     """
-    returnValue = self.__sendRequest(MilightWifiBridge.__LINK_CMD, zoneId)
+    returnValue = self.__sendRequest(MilightWifiBridge.getCommand("link"), zoneId)
     logging.debug("Link zone {}: {}".format(str(zoneId), str(returnValue)))
     return returnValue
 
@@ -605,7 +1350,7 @@ class MilightWifiBridge:
 
     return: (bool) Request received by the wifi bridge
     """
-    returnValue = self.__sendRequest(MilightWifiBridge.__UNLINK_CMD, zoneId)
+    returnValue = self.__sendRequest(MilightWifiBridge.getCommand("unlink"), zoneId)
     logging.debug("Unlink zone {}: {}".format(str(zoneId), str(returnValue)))
     return returnValue
 
@@ -620,7 +1365,7 @@ class MilightWifiBridge:
 
     return: (bool) Request received by the wifi bridge
     """
-    returnValue = self.__sendRequest(MilightWifiBridge.__getSetColorCmd(color), zoneId)
+    returnValue = self.__sendRequest(MilightWifiBridge.getCommand("setColor", color), zoneId)
     logging.debug("Set color {} to zone {}: {}".format(str(color), str(zoneId), str(returnValue)))
     return returnValue
 
@@ -634,7 +1379,7 @@ class MilightWifiBridge:
 
     return: (bool) Request received by the wifi bridge
     """
-    returnValue = self.__sendRequest(MilightWifiBridge.__getSetBridgeLampColorCmd(color), 0x01)
+    returnValue = self.__sendRequest(MilightWifiBridge.getCommand("setColorBridgeLamp", color), 0x01)
     logging.debug("Set color {} to wifi bridge: {}".format(str(color), str(returnValue)))
     return returnValue
 
@@ -647,7 +1392,7 @@ class MilightWifiBridge:
 
     return: (bool) Request received by the wifi bridge
     """
-    returnValue = self.__sendRequest(MilightWifiBridge.__getSetBrightnessCmd(brightness), zoneId)
+    returnValue = self.__sendRequest(MilightWifiBridge.getCommand("setBrightness", brightness), zoneId)
     logging.debug("Set brightness {}% to zone {}: {}".format(str(brightness), str(zoneId), str(returnValue)))
     return returnValue
 
@@ -659,7 +1404,7 @@ class MilightWifiBridge:
 
     return: (bool) Request received by the wifi bridge
     """
-    returnValue = self.__sendRequest(MilightWifiBridge.__getSetBrightnessForBridgeLampCmd(brightness), 0x01)
+    returnValue = self.__sendRequest(MilightWifiBridge.getCommand("setBrightnessBridgeLamp", brightness), 0x01)
     logging.debug("Set brightness {}% to the wifi bridge: {}".format(str(brightness), str(returnValue)))
     return returnValue
 
@@ -672,7 +1417,7 @@ class MilightWifiBridge:
 
     return: (bool) Request received by the wifi bridge
     """
-    returnValue = self.__sendRequest(MilightWifiBridge.__getSetSaturationCmd(saturation), zoneId)
+    returnValue = self.__sendRequest(MilightWifiBridge.getCommand("setSaturation", saturation), zoneId)
     logging.debug("Set saturation {}% to zone {}: {}".format(str(saturation), str(zoneId), str(returnValue)))
     return returnValue
 
@@ -685,17 +1430,511 @@ class MilightWifiBridge:
 
     return: (bool) Request received by the wifi bridge
     """
-    returnValue = self.__sendRequest(MilightWifiBridge.__getSetTemperatureCmd(temperature), zoneId)
+    returnValue = self.__sendRequest(MilightWifiBridge.getCommand("setTemperature", temperature), zoneId)
     logging.debug("Set temperature {}% ({} kelvin) to zone {}: {}"
                   .format(str(temperature), str(int(2700 + 38*temperature)), str(zoneId), str(returnValue)))
     return returnValue
 
-  def getMacAddress(self):
+  def getMacAddress(self, timeout_sec=None):
     """Request the MAC address of the milight wifi bridge
 
+    The cached session is used if there is one, otherwise a new session is started (and cached).
+
+    Keyword arguments:
+      timeout_sec -- (float, optional) Maximum time to wait for the wifi bridge (default: timeout given to setup())
+
     return: (string) MAC address of the wifi bridge (empty if an error occured)
     """
-    returnValue = self.__startSession().mac
+    with self.__lock:
+      returnValue = self.__getSession(timeout_sec).mac
+    logging.debug("Get MAC address: {}".format(str(returnValue)))
+    return returnValue
+
+
+class AsyncMilightWifiBridge(asyncio.DatagramProtocol):
+  """Milight 3.0 Wifi Bridge class for asyncio
+
+  Same public functions as MilightWifiBridge but as coroutines: one event loop can drive any number of
+  wifi bridges, a request waiting for its ACK does not block the other ones. Each request waits on a
+  future keyed by its sequence number so several requests are in flight on the same session.
+
+  The session cache, the retransmissions (deadline derived from the measured round trip time), the frame
+  rate limiter and the late ACK statistics are the ones of MilightWifiBridge (see MilightBridgeLink), only
+  the I/O differs. calibrateFrameRate() is only provided by MilightWifiBridge, give the measured rate to setup().
+
+  Calling (and awaiting) setup() function is necessary in order to make this class work properly.
+  """
+  __MAX_REQUESTS_IN_FLIGHT = 255
+
+  ################################### INIT ####################################
+  def __init__(self):
+    """Class must be initialized with setup()"""
+    super(AsyncMilightWifiBridge, self).__init__()
+    self.__transport = None
+    self.__pending_acks = {} # Sequence number -> future of the request waiting for its ACK
+    self.__pending_session = None
+    self.__session_lock = None
+    self.__requests_in_flight = None
+    self.__pipeline_window = 16
+    self.__wait_ack = True
+    # Round trip time estimation and statistics are kept when setup() is called again
+    self.__link = MilightBridgeLink()
+    self.close()
+
+
+  ################################### SETUP ####################################
+  def close(self):
+    """Close connection with Milight wifi bridge"""
+    self.__initialized = False
+    self.__link.reset()
+
+    if self.__transport is not None:
+      self.__transport.close()
+      self.__transport = None
+      logging.debug("Socket closed")
+
+    # Wake up the requests still waiting for an answer
+    for future in list(self.__pending_acks.values()):
+      if not future.done():
+        future.cancel()
+    self.__pending_acks.clear()
+    if self.__pending_session is not None and not self.__pending_session.done():
+      self.__pending_session.cancel()
+    self.__pending_session = None
+
+  async def setup(self, ip, port=5987, timeout_sec=5.0, session_ttl_sec=60.0, pipeline_window=16, retransmissions=3,
+                  wait_ack=True, frame_rate=0.0, frame_burst=5):
+    """Initialize the class (can be launched multiple time if setup changed or module crashed)
+
+    Same settings as MilightWifiBridge.setup(): the host name is resolved once, frames not answered in
+    time are sent again, every frame sent waits for a token of the frame rate limiter.
+
+    Keyword arguments:
+      ip -- (string) IP (or host name) to communication with the Milight wifi bridge
+      port -- (int, optional) UDP port to communication with the Milight wifi bridge
+      timeout_sec -- (int, optional) Maximum time in sec for Milight wifi bridge to answer commands
+      session_ttl_sec -- (float, optional) Time in sec a session is reused before a new start session
+                                           request is sent (0 to start a new session for each request)
+      pipeline_window -- (int, optional) Default maximum number of requests in flight for sendRequests()
+      retransmissions -- (int, optional) Number of times an unanswered frame is sent again
+      wait_ack -- (bool, optional) Wait for the ACK of the requests (see sendRequests())
+      frame_rate -- (float, optional) Maximum number of frames sent per sec (0 for no limit)
+      frame_burst -- (int, optional) Number of frames that can be sent at once before frame_rate applies
+
+    return: (bool) Milight wifi bridge initialized
+    """
+    # Close potential previous Milight wifi bridge session
+    self.close()
+
+    loop = asyncio.get_event_loop()
+    self.__link.configure(timeout_sec, session_ttl_sec, retransmissions)
+    self.__link.setFrameRate(frame_rate, frame_burst)
+    self.__pipeline_window = int(pipeline_window)
+    self.__wait_ack = bool(wait_ack)
+    self.__session_lock = asyncio.Lock()
+    self.__requests_in_flight = asyncio.Semaphore(AsyncMilightWifiBridge.__MAX_REQUESTS_IN_FLIGHT)
+
+    # Create new milight wifi bridge session
+    try:
+      address = (await loop.getaddrinfo(ip, port, family=socket.AF_INET, type=socket.SOCK_DGRAM))[0][4]
+      self.__transport = (await loop.create_datagram_endpoint(lambda: self, remote_addr=address))[0]
+      self.__initialized = True
+      logging.debug("UDP connection initialized with ip {} ({}) and port {}".format(str(ip), str(address[0]), str(port)))
+    except (OSError, socket.error, socket.herror, socket.gaierror) as err:
+      logging.error("Impossible to initialize the UDP connection with ip {} and port {}: {}".format(str(ip), str(port), str(err)))
+
+    return self.__initialized
+
+  def isInitialized(self):
+    """Tell if setup() succeeded and close() was not called since
+
+    return: (bool) Milight wifi bridge initialized
+    """
+    return self.__initialized
+
+  def setFrameRate(self, frame_rate, frame_burst=None):
+    """Change the maximum number of frames sent per sec (see MilightWifiBridge.setFrameRate())"""
+    self.__link.setFrameRate(frame_rate, frame_burst)
+
+
+  ############################ DATAGRAM PROTOCOL ##############################
+  def datagram_received(self, data, addr):
+    """Dispatch a frame received from the wifi bridge to the request waiting for it"""
+    if len(data) == 22:
+      if self.__pending_session is not None and not self.__pending_session.done():
+        self.__pending_session.set_result(data)
+      else:
+        logging.debug("Ignoring start session response (not waiting for it)")
+    elif len(data) == 8:
+      future = self.__pending_acks.get(data[6])
+      if future is not None and not future.done():
+        future.set_result(data[7])
+      elif not self.__link.countLateAck(data):
+        logging.debug("Ignoring ack of sequence number {} (not waiting for it)".format(str(data[6])))
+    else:
+      logging.warning("Invalid response size {}".format(str(len(data))))
+
+  def error_received(self, exc):
+    """Fail the requests waiting for an answer (ex: ICMP port unreachable reported on the connected socket)"""
+    logging.warning("UDP error: {}".format(str(exc)))
+    futures = list(self.__pending_acks.values())
+    if self.__pending_session is not None:
+      futures.append(self.__pending_session)
+    for future in futures:
+      if not future.done():
+        future.set_exception(exc)
+
+  def connection_lost(self, exc):
+    self.__initialized = False
+
+
+  ######################### INTERNAL UTILITY FUNCTIONS #########################
+  async def __waitToken(self):
+    """Wait until the frame rate limiter allows sending a frame"""
+    delay = self.__link.takeToken()
+    while delay > 0:
+      await asyncio.sleep(delay)
+      delay = self.__link.takeToken()
+
+  async def __waitAnswer(self, future, deadline):
+    """Wait for the answer resolving future until deadline (the future is kept to wait for it again)
+
+    return: Answer (None if there is no answer before deadline, if the request failed or the connection was closed)
+    """
+    try:
+      return await asyncio.wait_for(asyncio.shield(future), max(0.001, deadline - time.monotonic()))
+    except asyncio.TimeoutError:
+      return None
+    except asyncio.CancelledError:
+      if not future.cancelled():
+        raise
+      logging.warning("Connection closed while waiting for an answer")
+    except OSError as err:
+      logging.warning("Request failed: {}".format(str(err)))
+    return None
+
+  @staticmethod
+  def __discardAnswer(future):
+    """Forget the answer of a request no longer waiting for it (an error set by error_received() is not reported again)"""
+    if future.done() and not future.cancelled():
+      future.exception()
+
+  async def __startSession(self, timeout_sec=None):
+    """Send start session request and return start session information
+
+    The start session frame is sent again if the wifi bridge does not answer before the handshake
+    deadline (see MilightBridgeLink.getHandshakeTimeout()), up to the number of retransmissions given to setup().
+
+    Keyword arguments:
+      timeout_sec -- (float, optional) Maximum time to wait for the wifi bridge (default: timeout given to setup())
+
+    return: (MilightWifiBridge.__START_SESSION_RESPONSE) Start session information (see MilightWifiBridge)
+    """
+    link = self.__link
+    response = MilightWifiBridge.parseStartSessionResponse(b"")
+    if timeout_sec is None or timeout_sec > link.timeout_sec:
+      timeout_sec = link.timeout_sec
+    giveUp = time.monotonic() + timeout_sec
+    future = asyncio.get_event_loop().create_future()
+    self.__pending_session = future
+
+    try:
+      for attempt in range(link.retransmissions + 1):
+        await self.__waitToken()
+        if self.__transport is None or future.done():
+          break
+        logging.debug("Sending start session frame")
+        sentAt = time.monotonic()
+        self.__transport.sendto(MilightWifiBridge.getStartSessionRequest())
+        data = await self.__waitAnswer(future, min(giveUp, sentAt + link.getHandshakeTimeout() * (2 ** attempt)))
+        if data is not None:
+          response = MilightWifiBridge.parseStartSessionResponse(data)
+          if attempt == 0:
+            link.addRoundTripTimeSample(time.monotonic() - sentAt)
+          logging.debug("Start session (mac address: {}, session ID 1: {}, session ID 2: {})"
+                        .format(str(response.mac), str(response.sessionId1), str(response.sessionId2)))
+          break
+        if future.done() or time.monotonic() >= giveUp:
+          break
+        logging.info("No start session response, sending start session request again")
+    finally:
+      if self.__pending_session is future:
+        self.__pending_session = None
+      AsyncMilightWifiBridge.__discardAnswer(future)
+
+    if not response.responseReceived:
+      logging.warning("Timed out for start session response")
+    return response
+
+  async def __getSession(self, timeout_sec=None):
+    """Give the cached session, start a new one if there is none or if it expired
+
+    Concurrent requests needing a new session wait for the same start session exchange.
+
+    return: (MilightWifiBridge.__START_SESSION_RESPONSE) Start session information (see MilightWifiBridge)
+    """
+    async with self.__session_lock:
+      session = self.__link.getSession()
+      if session is not None:
+        return session
+
+      response = await self.__startSession(timeout_sec)
+      self.__link.setSession(response)
+      return response
+
+  def invalidateSession(self):
+    """Forget the cached session so the next request starts a new one"""
+    self.__link.invalidateSession()
+
+  def getRoundTripTime(self):
+    """Give the smoothed round trip time with the wifi bridge
+
+    return: (float) Smoothed round trip time in sec (None if the wifi bridge never answered)
+    """
+    return self.__link.getRoundTripTime()
+
+  async def ping(self, timeout_sec=None, fresh=False):
+    """Check the wifi bridge answers a start session request (see MilightWifiBridge.ping())
+
+    return: (bool) Wifi bridge answered
+    """
+    if not self.__initialized:
+      return False
+    if fresh:
+      self.__link.invalidateSession()
+    returnValue = (await self.__getSession(timeout_sec)).responseReceived
+    logging.debug("Ping: {}".format(str(returnValue)))
+    return returnValue
+
+  async def __sendAcknowledged(self, index, command, zoneId, session, window, onAck):
+    """Send a request and wait for its ACK, sending it again (same frame and sequence number) if it is not
+    acknowledged in time
+
+    return: (int) ACK status (None if the request was not acknowledged)
+    """
+    link = self.__link
+    async with window, self.__requests_in_flight:
+      sequenceNumber = link.nextSequenceNumber(self.__pending_acks)
+      future = asyncio.get_event_loop().create_future()
+      self.__pending_acks[sequenceNumber] = future
+      frame = MilightWifiBridge.getRequestFrame(command, zoneId, session.sessionId1, session.sessionId2, sequenceNumber)
+      logging.debug("Sending request with command '{}' with session ID 1 '{}', session ID 2 '{}' and sequence number '{}'"
+                    .format(str(binascii.hexlify(command)), str(session.sessionId1),
+                            str(session.sessionId2), str(sequenceNumber)))
+      firstSentAt = None
+      try:
+        for attempt in range(link.retransmissions + 1):
+          await self.__waitToken()
+          now = time.monotonic()
+          if firstSentAt is None:
+            firstSentAt = now
+            giveUp = now + link.timeout_sec
+          elif now >= giveUp:
+            break
+          if self.__transport is None or future.done():
+            break
+          if attempt > 0:
+            logging.info("No response to sequence number {}, sending it again (retransmission {})"
+                         .format(str(sequenceNumber), str(attempt)))
+          self.__transport.sendto(frame)
+          status = await self.__waitAnswer(future, min(giveUp, now + link.getAckTimeout() * (2 ** attempt)))
+          if status is None:
+            continue
+          # Only frames sent once give a reliable round trip time (Karn's algorithm)
+          if attempt == 0:
+            link.addRoundTripTimeSample(time.monotonic() - now)
+          if status == 0x00:
+            logging.debug("Received valid response for request with sequence number {}".format(str(sequenceNumber)))
+            if onAck is not None:
+              onAck(index, time.monotonic() - firstSentAt)
+          return status
+        logging.warning("Timed out for response to sequence number {}".format(str(sequenceNumber)))
+        return None
+      finally:
+        if self.__pending_acks.get(sequenceNumber) is future:
+          del self.__pending_acks[sequenceNumber]
+        AsyncMilightWifiBridge.__discardAnswer(future)
+
+  async def sendRequests(self, requests, window=None, waitAck=None, onAck=None):
+    """Send several commands without waiting for the ACK of a command before sending the next one
+
+    Same behaviour as MilightWifiBridge.sendRequests(): up to 'window' requests are in flight at the same
+    time on the same session, without waiting for the ACKs every request is sent once (their ACKs are
+    counted as they are received, see getSendStatistics()).
+
+    Keyword arguments:
+      requests -- (list of (bytes, int)) Commands (see MilightWifiBridge.getCommand()) and zone ID they must be sent to
+      window -- (int, optional) Maximum number of requests waiting for their ACK (between 1 and 255,
+                                default value given to setup())
+      waitAck -- (bool, optional) Wait for the ACK of the requests (default value given to setup())
+      onAck -- (function, optional) Called with (request index, time in sec since the request was first sent)
+                                    as soon as a request is acknowledged
+
+    return: (list of bool) Request received by the wifi bridge (request sent if not waiting for the ACKs),
+                           for each request
+    """
+    returnValues = [False] * len(requests)
+    if window is None:
+      window = self.__pipeline_window
+    window = max(1, min(int(window), AsyncMilightWifiBridge.__MAX_REQUESTS_IN_FLIGHT))
+    if waitAck is None:
+      waitAck = self.__wait_ack
+
+    # Send request only if valid parameters
+    toSend = []
+    for index, (command, zoneId) in enumerate(requests):
+      if len(command) != 9:
+        logging.error("Invalid command size {} instead of 9".format(str(len(command))))
+      elif int(zoneId) < 0 or int(zoneId) > 4:
+        logging.error("Invalid zone {} (must be between 0 and 4)".format(str(zoneId)))
+      else:
+        toSend.append(index)
+    if len(toSend) == 0:
+      return returnValues
+    if not self.__initialized:
+      logging.warning("Requests while the connection is not initialized")
+      return returnValues
+
+    link = self.__link
+    link.expireUnacknowledged()
+    reusedSession = link.getSession() is not None
+    session = await self.__getSession()
+    if not session.responseReceived:
+      logging.warning("Start session failed")
+      return returnValues
+
+    if not waitAck:
+      # Send the requests once, their sequence number is kept to count the late ACKs
+      for index in toSend:
+        command, zoneId = requests[index]
+        sequenceNumber = link.nextSequenceNumber(self.__pending_acks)
+        frame = MilightWifiBridge.getRequestFrame(command, zoneId, session.sessionId1, session.sessionId2, sequenceNumber)
+        await self.__waitToken()
+        if self.__transport is None:
+          link.invalidateSession()
+          break
+        self.__transport.sendto(frame)
+        link.addUnacknowledged(sequenceNumber)
+        returnValues[index] = True
+      logging.debug("Sent {} request(s) without waiting for their ACK".format(str(sum(returnValues))))
+      return returnValues
+
+    windowSemaphore = asyncio.Semaphore(window)
+    statuses = await asyncio.gather(*[self.__sendAcknowledged(index, requests[index][0], requests[index][1], session,
+                                                              windowSemaphore, onAck) for index in toSend])
+    rejected = []
+    for index, status in zip(toSend, statuses):
+      if status == 0x00:
+        returnValues[index] = True
+      elif status is not None:
+        rejected.append(index)
+
+    if len(rejected) > 0 and reusedSession:
+      # The wifi bridge no longer knows the cached session: start a new one and send again
+      logging.info("Session rejected by the wifi bridge, starting a new session")
+      link.invalidateSession()
+      retried = await self.sendRequests([requests[index] for index in rejected], window, waitAck=True,
+                                        onAck=None if onAck is None else lambda index, elapsed: onAck(rejected[index], elapsed))
+      for index, returnValue in zip(rejected, retried):
+        returnValues[index] = returnValue
+    elif len(rejected) > 0:
+      logging.warning("{} request(s) rejected by the wifi bridge".format(str(len(rejected))))
+
+    # Do not trust the cached session anymore if the wifi bridge did not acknowledge every request
+    if not all(returnValues[index] for index in toSend):
+      link.invalidateSession()
+
+    return returnValues
+
+  def getSendStatistics(self):
+    """Give the outcome of the requests sent without waiting for their ACK (since the instance was created)
+
+    return: (SendStatistics) Requests sent, acknowledged later, lost and still pending (see MilightBridgeLink)
+    """
+    self.__link.expireUnacknowledged()
+    return self.__link.getSendStatistics()
+
+  async def __sendRequest(self, command, zoneId):
+    """Send command to a specific zone and wait for its ACK
+
+    return: (bool) Request received by the wifi bridge
+    """
+    return (await self.sendRequests([(command, zoneId)], window=1))[0]
+
+
+  ######################### PUBLIC FUNCTIONS #########################
+  # See MilightWifiBridge for the documentation of each request
+  async def turnOn(self, zoneId):
+    return await self.__sendRequest(MilightWifiBridge.getCommand("turnOn"), zoneId)
+
+  async def turnOff(self, zoneId):
+    return await self.__sendRequest(MilightWifiBridge.getCommand("turnOff"), zoneId)
+
+  async def turnOnWifiBridgeLamp(self):
+    return await self.__sendRequest(MilightWifiBridge.getCommand("turnOnWifiBridgeLamp"), 0x01)
+
+  async def turnOffWifiBridgeLamp(self):
+    return await self.__sendRequest(MilightWifiBridge.getCommand("turnOffWifiBridgeLamp"), 0x01)
+
+  async def setNightMode(self, zoneId):
+    return await self.__sendRequest(MilightWifiBridge.getCommand("setNightMode"), zoneId)
+
+  async def setWhiteMode(self, zoneId):
+    return await self.__sendRequest(MilightWifiBridge.getCommand("setWhiteMode"), zoneId)
+
+  async def setWhiteModeBridgeLamp(self):
+    return await self.__sendRequest(MilightWifiBridge.getCommand("setWhiteModeBridgeLamp"), 0x01)
+
+  async def setDiscoMode(self, discoMode, zoneId):
+    return await self.__sendRequest(MilightWifiBridge.getCommand("setDiscoMode", discoMode), zoneId)
+
+  async def setDiscoModeBridgeLamp(self, discoMode):
+    return await self.__sendRequest(MilightWifiBridge.getCommand("setDiscoModeBridgeLamp", discoMode), 0x01)
+
+  async def speedUpDiscoMode(self, zoneId):
+    return await self.__sendRequest(MilightWifiBridge.getCommand("speedUpDiscoMode"), zoneId)
+
+  async def speedUpDiscoModeBridgeLamp(self):
+    return await self.__sendRequest(MilightWifiBridge.getCommand("speedUpDiscoModeBridgeLamp"), 0x01)
+
+  async def slowDownDiscoMode(self, zoneId):
+    return await self.__sendRequest(MilightWifiBridge.getCommand("slowDownDiscoMode"), zoneId)
+
+  async def slowDownDiscoModeBridgeLamp(self):
+    return await self.__sendRequest(MilightWifiBridge.getCommand("slowDownDiscoModeBridgeLamp"), 0x01)
+
+  async def link(self, zoneId):
+    return await self.__sendRequest(MilightWifiBridge.getCommand("link"), zoneId)
+
+  async def unlink(self, zoneId):
+    return await self.__sendRequest(MilightWifiBridge.getCommand("unlink"), zoneId)
+
+  async def setColor(self, color, zoneId):
+    return await self.__sendRequest(MilightWifiBridge.getCommand("setColor", color), zoneId)
+
+  async def setColorBridgeLamp(self, color):
+    return await self.__sendRequest(MilightWifiBridge.getCommand("setColorBridgeLamp", color), 0x01)
+
+  async def setBrightness(self, brightness, zoneId):
+    return await self.__sendRequest(MilightWifiBridge.getCommand("setBrightness", brightness), zoneId)
+
+  async def setBrightnessBridgeLamp(self, brightness):
+    return await self.__sendRequest(MilightWifiBridge.getCommand("setBrightnessBridgeLamp", brightness), 0x01)
+
+  async def setSaturation(self, saturation, zoneId):
+    return await self.__sendRequest(MilightWifiBridge.getCommand("setSaturation", saturation), zoneId)
+
+  async def setTemperature(self, temperature, zoneId):
+    return await self.__sendRequest(MilightWifiBridge.getCommand("setTemperature", temperature), zoneId)
+
+  async def getMacAddress(self, timeout_sec=None):
+    """Request the MAC address of the milight wifi bridge (the cached session is used if there is one)
+
+    return: (string) MAC address of the wifi bridge (empty if an error occured)
+    """
+    if not self.__initialized:
+      return ""
+    returnValue = (await self.__getSession(timeout_sec)).mac
     logging.debug("Get MAC address: {}".format(str(returnValue)))
     return returnValue
 
@@ -1040,6 +2279,35 @@ def __help(func="", filename=__file__):
   elif func == "":
     print("SET DISCO MODE FOR BRIDGE LAMP (-1, --setDiscoModeBridgeLamp): Set disco mode for bridge lamp (between 1 and 9)")
 
+  # Batch
+  if func == "batch":
+    print("Send the commands of a file (or of the standard input with '-') over one connection and print\r\n"
+          +"the result and latency of each command\r\n"
+          +"\r\n"
+          +"One command per line: zone (0 to 4, ignored by the bridge lamp commands), action (name of a\r\n"
+          +"MilightWifiBridge function, ex: turnOn, setColor, setBrightnessBridgeLamp) and value if the action\r\n"
+          +"has one. Empty lines and lines starting with '#' are ignored.\r\n"
+          +"\r\n"
+          +"Usage:\r\n"
+          +filename+" --ip 192.168.1.23 -B [file]\r\n"
+          +filename+" --ip 192.168.1.23 --batch [file]\r\n"
+          +"\r\n"
+          +"Example:\r\n"
+          +"printf '1 turnOn\\n1 setBrightness 50\\n2 setColor 122\\n' | "+filename+" --ip 192.168.1.23 --batch -\r\n")
+    return
+  elif func == "":
+    print("BATCH (-B, --batch): Send the commands of a file (or '-' for the standard input) over one connection")
+
+  # Pipeline
+  if func == "pipeline":
+    print("Send the commands of the batch without waiting for the ACK of a command before sending the next one\r\n"
+          +"\r\n"
+          +"Usage:\r\n"
+          +filename+" --ip 192.168.1.23 --batch commands.txt -P\r\n"
+          +filename+" --ip 192.168.1.23 --batch commands.txt --pipeline\r\n")
+    return
+  elif func == "":
+    print("PIPELINE (-P, --pipeline): Send the commands of the batch without waiting for each ACK")
 
   # Add use case examples:
   if func == "":
@@ -1054,6 +2322,97 @@ def __help(func="", filename=__file__):
           +" - Light off all zone: "+filename+" --ip 192.168.1.23 --port 5987 --zone 0 --lightOff")
 
 
+################################# BATCH FUNCTIONS ###############################
+# Range of the value of the actions having one
+__BATCH_VALUE_RANGES = {
+  "setColor": (0, 255),
+  "setColorBridgeLamp": (0, 255),
+  "setBrightness": (0, 100),
+  "setBrightnessBridgeLamp": (0, 100),
+  "setSaturation": (0, 100),
+  "setTemperature": (0, 100),
+  "setDiscoMode": (1, 9),
+  "setDiscoModeBridgeLamp": (1, 9),
+}
+
+def __parseBatch(lines):
+  """Parse the commands of a batch (see the 'batch' help)
+
+  Keyword arguments:
+    lines -- (iterable of string) Lines of the batch
+
+  return: (list of (int, string, bytes, int)) Line number, line, command and zone ID of each command
+
+  Raise ValueError if a line is invalid or if there is no command
+  """
+  actions = dict((action.lower(), action) for action in MilightWifiBridge.getActions())
+  commands = []
+  for lineNumber, line in enumerate(lines, 1):
+    line = line.strip()
+    if line == "" or line.startswith("#"):
+      continue
+    fields = line.split()
+    if len(fields) < 2 or fields[1].lower() not in actions:
+      raise ValueError("line {}: expected 'zone action [value]', got '{}'".format(lineNumber, line))
+    try:
+      zone = int(fields[0])
+    except ValueError:
+      raise ValueError("line {}: zone must be a number, got '{}'".format(lineNumber, fields[0]))
+    if zone < 0 or zone > 4:
+      raise ValueError("line {}: zone must be between 0 and 4".format(lineNumber))
+    action = actions[fields[1].lower()]
+    valueRange = __BATCH_VALUE_RANGES.get(action)
+    if (valueRange is None) != (len(fields) == 2) or len(fields) > 3:
+      raise ValueError("line {}: {} {}".format(lineNumber, action, "takes no value" if valueRange is None
+                                                                     else "needs a value"))
+    value = None
+    if valueRange is not None:
+      try:
+        value = int(fields[2])
+      except ValueError:
+        raise ValueError("line {}: value of {} must be a number, got '{}'".format(lineNumber, action, fields[2]))
+      if value < valueRange[0] or value > valueRange[1]:
+        raise ValueError("line {}: value of {} must be between {} and {}".format(lineNumber, action, valueRange[0],
+                                                                                 valueRange[1]))
+    # The bridge lamp commands are sent to zone 1 (as the public functions do)
+    if action.endswith("BridgeLamp"):
+      zone = 0x01
+    commands.append((lineNumber, line, MilightWifiBridge.getCommand(action, value), zone))
+  if len(commands) == 0:
+    raise ValueError("no command")
+  return commands
+
+def __runBatch(milight, commands, pipeline):
+  """Send the commands of a batch and print the result and latency of each one
+
+  Keyword arguments:
+    milight -- (MilightWifiBridge) Initialized wifi bridge
+    commands -- (list of (int, string, bytes, int)) Commands (see __parseBatch())
+    pipeline -- (bool) Send the commands without waiting for the ACK of a command before sending the next one
+
+  return: (bool) Every command received by the wifi bridge
+  """
+  latencies = [None] * len(commands)
+  start = time.monotonic()
+  if pipeline:
+    def onAck(index, elapsed):
+      latencies[index] = elapsed
+    results = milight.sendRequests([(command, zone) for _, _, command, zone in commands], onAck=onAck)
+  else:
+    results = []
+    for index, (_, _, command, zone) in enumerate(commands):
+      sentAt = time.monotonic()
+      results.append(milight.sendRequests([(command, zone)], window=1)[0])
+      latencies[index] = time.monotonic() - sentAt
+  elapsed = time.monotonic() - start
+
+  for (lineNumber, line, _, _), result, latency in zip(commands, results, latencies):
+    print("{}: {} -> {} ({:.1f} ms)".format(lineNumber, line, "OK" if result else "FAILED",
+                                           (latency or 0.0) * 1000.0))
+  print("{}/{} command(s) succeeded in {:.1f} ms".format(sum(results), len(commands), elapsed * 1000.0))
+  return all(results)
+
+
 ################################# MAIN FUNCTION ###############################
 def main(parsed_args = sys.argv[1:]):
   """Shell Milight utility function"""
@@ -1066,16 +2425,19 @@ def main(parsed_args = sys.argv[1:]):
   port = 5987 # Default milight 3.0 port
   zone = 0 # By default, all zone are controlled
   timeout = 5.0 # By default, Wait maximum 5sec
+  batch = None # Commands of the batch file (if any)
+  pipeline = False # By default, wait for the ACK of each command of the batch before sending the next one
 
   # Get options
   try:
-    opts, args = getopt.getopt(parsed_args, "i:p:t:z:hmluofx23ynwagc:b:s:e:d:jkqr:v:1:",
+    opts, args = getopt.getopt(parsed_args, "i:p:t:z:hmluofx23ynwagc:b:s:e:d:jkqr:v:1:B:P",
                                ["ip=", "port=", "timeout=", "zone=", "help", "debug", "nodebug",
                                 "getMacAddress", "link", "unlink", "turnOn", "turnOff", "turnOnWifiBridgeLamp",
                                 "turnOffWifiBridgeLamp", "setNightMode", "setWhiteMode", "speedUpDiscoMode", "slowDownDiscoMode",
                                 "setColor=", "setBrightness=", "setSaturation=", "setTemperature=", "setDiscoMode=",
                                 "setWhiteModeBridgeLamp", "speedUpDiscoModeBridgeLamp", "slowDownDiscoModeBridgeLamp",
-                                "setColorBridgeLamp=", "setBrightnessBridgeLamp=", "setDiscoModeBridgeLamp="])
+                                "setColorBridgeLamp=", "setBrightnessBridgeLamp=", "setDiscoModeBridgeLamp=",
+                                "batch=", "pipeline"])
   except getopt.GetoptError as err:
     print("[ERROR] "+str(err))
     __help()
@@ -1112,6 +2474,21 @@ def main(parsed_args = sys.argv[1:]):
     if o in ("-z", "--zone"):
       zone = int(a)
       continue
+    if o in ("-P", "--pipeline"):
+      pipeline = True
+      continue
+    if o in ("-B", "--batch"):
+      try:
+        if a == "-":
+          batch = __parseBatch(sys.stdin)
+        else:
+          with open(a) as f:
+            batch = __parseBatch(f)
+      except (IOError, ValueError) as err:
+        print("[ERROR] Invalid batch: "+str(err)+"\r\n")
+        __help("batch")
+        sys.exit(1)
+      continue
 
   # Check base parameters
   if ip == "":
@@ -1260,6 +2637,11 @@ def main(parsed_args = sys.argv[1:]):
     if not returnValue:
       break
 
+  # Execute the batch (after the commands of the command line)
+  if batch is not None and returnValue:
+    atLeastOneRequestDone = True
+    returnValue &= __runBatch(milight, batch, pipeline)
+
   if not atLeastOneRequestDone:
     print("[ERROR] You must call one action, use '-h' to get more information.")
     sys.exit(1)
@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+
+"""
+Local emulator of a Milight iBox / LimitlessLED v6 wifi bridge.
+
+It answers the real protocol on UDP: the 27 bytes start session frame gets the 22 bytes response
+carrying the MAC address and the session IDs, every 22 bytes command frame gets the 8 bytes ACK echoing
+its sequence number. Latency, jitter, loss and reordering of the answers can be configured so the
+MilightWifiBridge client and the NodeServer can be measured without real hardware. A capacity makes it
+drop the frames received faster than it can handle them, as a flooded bridge does.
+
+With a discovery port, it also answers the LAN discovery request ("HF-A11ASSISTHREAD") with "ip,MAC,name".
+
+Usage: python3 bench/bridge_emulator.py --port 5987 --latency 0.005 --jitter 0.002 --loss 0.01
+"""
+
+import argparse
+import heapq
+import itertools
+import logging
+import random
+import socket
+import threading
+import time
+
+
+LOGGER = logging.getLogger(__name__)
+
+START_SESSION_SIZE = 27
+REQUEST_SIZE = 22
+DISCOVERY_REQUEST = b'HF-A11ASSISTHREAD'
+
+class BridgeEmulator(object):
+    """Emulated v6 wifi bridge listening on a local UDP port
+
+    Keyword arguments:
+      host -- (string) Address to listen on
+      port -- (int) UDP port to listen on (0 for any free port, see self.port)
+      latency -- (float) Time in sec before an answer is sent
+      jitter -- (float) Random variation in sec added to or removed from the latency
+      loss -- (float) Probability (0 to 1) that a received frame is ignored
+      reorder -- (float) Probability (0 to 1) that an answer is delayed behind the next ones
+      mac -- (bytes) MAC address of the bridge (6 bytes)
+      discoveryPort -- (int) UDP port answering the discovery request (None: no discovery, 0: any free port,
+                       see self.discoveryPort)
+      capacity -- (float) Frames handled per sec, the others are dropped (0 for no limit)
+      capacityBurst -- (int) Frames handled at once before capacity applies
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, jitter=0.0, loss=0.0, reorder=0.0,
+                 mac=b'\xac\xcf\x23\x00\x00\x01', seed=None, discoveryPort=None, capacity=0.0, capacityBurst=5):
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.reorder = reorder
+        self.capacity = capacity
+        self.capacityBurst = capacityBurst
+        self.__credit = float(capacityBurst)
+        self.__creditUpdated = time.monotonic()
+        self.mac = bytes(mac)
+        self.sessionId1 = 0
+        self.sessionId2 = 0
+        self.handshakes = 0
+        self.requests = 0
+        self.invalidRequests = 0
+        self.dropped = 0
+        self.zones = {} # Zone ID -> last command (9 bytes) received for the zone
+        self.__random = random.Random(seed)
+        self.__sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.__sock.bind((host, port))
+        self.host, self.port = self.__sock.getsockname()
+        self.discoveryPort = None
+        self.discoveries = 0
+        self.__discoverySock = None
+        if discoveryPort is not None:
+            self.__discoverySock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.__discoverySock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.__discoverySock.bind((host, discoveryPort))
+            self.discoveryPort = self.__discoverySock.getsockname()[1]
+        self.__answers = []
+        self.__counter = itertools.count()
+        self.__condition = threading.Condition()
+        self.__running = False
+        self.__threads = []
+        self.newSession()
+
+    def newSession(self):
+        """Give new session IDs, requests using the previous ones are rejected"""
+        self.sessionId1 = self.__random.randint(0, 0xFF)
+        self.sessionId2 = self.__random.randint(0, 0xFF)
+
+    def start(self):
+        self.__running = True
+        targets = [self.__receive, self.__answer]
+        if self.__discoverySock is not None:
+            targets.append(self.__discover)
+        for target in targets:
+            thread = threading.Thread(target=target, name='emulator-' + str(self.port))
+            thread.daemon = True
+            thread.start()
+            self.__threads.append(thread)
+        return self
+
+    def stop(self):
+        self.__running = False
+        with self.__condition:
+            self.__condition.notify()
+        for sock in (self.__sock, self.__discoverySock):
+            if sock is None:
+                continue
+            try:
+                sock.close()
+            except socket.error:
+                pass
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def __receive(self):
+        while self.__running:
+            try:
+                data, address = self.__sock.recvfrom(1024)
+            except socket.error:
+                return
+            if self.__random.random() < self.loss or not self.__handled():
+                self.dropped += 1
+                continue
+            answer = self.handle(data)
+            if answer is not None:
+                self.__schedule(answer, address)
+
+    def __handled(self):
+        """Give whether a frame received now is within the capacity of the bridge"""
+        if self.capacity <= 0:
+            return True
+        now = time.monotonic()
+        self.__credit = min(self.capacityBurst, self.__credit + (now - self.__creditUpdated) * self.capacity)
+        self.__creditUpdated = now
+        if self.__credit < 1.0:
+            return False
+        self.__credit -= 1.0
+        return True
+
+    def __discover(self):
+        while self.__running:
+            try:
+                data, address = self.__discoverySock.recvfrom(1024)
+            except socket.error:
+                return
+            if data.strip() != DISCOVERY_REQUEST:
+                continue
+            self.discoveries += 1
+            answer = '{},{},HF-LPB100'.format(self.host, ''.join('{:02X}'.format(byte) for byte in self.mac))
+            try:
+                self.__discoverySock.sendto(answer.encode('ascii'), address)
+            except socket.error:
+                return
+
+    def handle(self, data):
+        """Give the answer of the bridge to a frame (None if the bridge does not answer)"""
+        if len(data) == START_SESSION_SIZE and data[0] == 0x20:
+            self.handshakes += 1
+            return (bytes([0x28, 0x00, 0x00, 0x00, 0x11, 0x00, 0x02]) + self.mac +
+                    bytes([0x69, 0xF0, 0x3C, 0x23, 0x00, 0x01, self.sessionId1, self.sessionId2, 0x00]))
+
+        if len(data) == REQUEST_SIZE and data[0] == 0x80:
+            self.requests += 1
+            command = bytes(data[10:19])
+            zoneId = data[19]
+            valid = ((data[5], data[6]) == (self.sessionId1, self.sessionId2) and
+                     (sum(command) + zoneId) & 0xFF == data[21])
+            if valid:
+                self.zones[zoneId] = command
+            else:
+                self.invalidRequests += 1
+            return bytes([0x88, 0x00, 0x00, 0x00, 0x03, 0x00, data[8], 0x00 if valid else 0x01])
+
+        LOGGER.debug('Ignoring frame of %d bytes', len(data))
+        return None
+
+    def __schedule(self, answer, address):
+        delay = max(0.0, self.latency + self.__random.uniform(-self.jitter, self.jitter))
+        if self.__random.random() < self.reorder:
+            delay += self.latency + self.jitter + 0.001
+        with self.__condition:
+            heapq.heappush(self.__answers, (time.monotonic() + delay, next(self.__counter), answer, address))
+            self.__condition.notify()
+
+    def __answer(self):
+        while self.__running:
+            with self.__condition:
+                if len(self.__answers) == 0:
+                    self.__condition.wait(0.5)
+                    continue
+                remaining = self.__answers[0][0] - time.monotonic()
+                if remaining > 0:
+                    self.__condition.wait(remaining)
+                    continue
+                answer, address = heapq.heappop(self.__answers)[2:]
+            try:
+                self.__sock.sendto(answer, address)
+            except socket.error:
+                return
+
+def main():
+    parser = argparse.ArgumentParser(description='Emulate a Milight v6 wifi bridge on a local UDP port')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5987)
+    parser.add_argument('--latency', type=float, default=0.005, help='answer latency in sec')
+    parser.add_argument('--jitter', type=float, default=0.0, help='latency variation in sec')
+    parser.add_argument('--loss', type=float, default=0.0, help='probability a frame is ignored')
+    parser.add_argument('--reorder', type=float, default=0.0, help='probability an answer is reordered')
+    parser.add_argument('--discovery-port', type=int, default=None,
+                        help='also answer the LAN discovery request on this port (48899 for real clients)')
+    parser.add_argument('--capacity', type=float, default=0.0,
+                        help='frames handled per sec, the others are dropped (0 for no limit)')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    emulator = BridgeEmulator(args.host, args.port, args.latency, args.jitter, args.loss, args.reorder,
+                              discoveryPort=args.discovery_port, capacity=args.capacity).start()
+    LOGGER.info('Emulated bridge listening on %s:%d', emulator.host, emulator.port)
+    if emulator.discoveryPort is not None:
+        LOGGER.info('Answering discovery requests on %s:%d', emulator.host, emulator.discoveryPort)
+    try:
+        while True:
+            time.sleep(10)
+            LOGGER.info('handshakes=%d requests=%d invalid=%d dropped=%d', emulator.handshakes,
+                        emulator.requests, emulator.invalidRequests, emulator.dropped)
+    except KeyboardInterrupt:
+        emulator.stop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+"""
+Scripted check of the bridge discovery against emulated bridges (see bridge_emulator.py).
+
+Emulated bridges answer the LAN discovery request on local ports, then the discovery runs as the NodeServer
+does it:
+  - every emulated bridge is found with its IP and MAC address
+  - the MAC address given by the handshake of a bridge (used to skip a discovered bridge also configured by
+    host name) is the one given by the discovery
+  - the node addresses remembered by MAC address do not change when bridges stop answering, come back,
+    change IP or new ones appear
+
+Exits with 1 if a check fails.
+
+Usage: python3 bench/discovery_check.py --bridges 3
+"""
+
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from MilightWifiBridge import MilightWifiBridge
+from milight_bridges import BridgeClientRegistry, probeClients, rememberBridges
+from bridge_emulator import BridgeEmulator
+
+
+class Checks(object):
+    """Count and print the check results"""
+
+    def __init__(self):
+        self.failed = 0
+
+    def check(self, description, passed, details=''):
+        print('{} {}{}'.format('ok    ' if passed else 'FAILED', description, ' (' + details + ')' if details else ''))
+        if not passed:
+            self.failed += 1
+
+def discover(emulators, timeout):
+    """Bridges answering the discovery request of each emulator, as the NodeServer receives them"""
+    bridges = []
+    for emulator in emulators:
+        bridges += MilightWifiBridge.discoverBridges(timeout, emulator.host, emulator.discoveryPort)
+    return bridges
+
+def addresses(remembered):
+    return dict((mac, address) for mac, ip, address in remembered)
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the bridge discovery against emulated bridges')
+    parser.add_argument('--bridges', type=int, default=3, help='number of emulated bridges (at least 2)')
+    parser.add_argument('--timeout', type=float, default=0.5, help='discovery timeout in sec')
+    args = parser.parse_args()
+    args.bridges = max(2, args.bridges)
+
+    emulators = [BridgeEmulator(mac=bytes([0xAC, 0xCF, 0x23, 0x00, 0x00, index + 1]), discoveryPort=0).start()
+                 for index in range(args.bridges)]
+    checks = Checks()
+    try:
+        found = discover(emulators, args.timeout)
+        macs = [bridge.mac for bridge in found]
+        checks.check('every bridge is discovered', len(set(macs)) == len(emulators),
+                     ', '.join('{} {}'.format(bridge.ip, bridge.mac) for bridge in found))
+        checks.check('every bridge answers with its IP', all(bridge.ip == emulators[0].host for bridge in found))
+
+        registry = BridgeClientRegistry(refreshInterval=0)
+        clients = [registry.acquire(emulator.host, emulator.port, 1.0) for emulator in emulators]
+        try:
+            probed = probeClients(clients, 1.0)
+        finally:
+            registry.closeAll()
+        checks.check('the handshake gives the discovered MAC addresses', probed == macs, ', '.join(probed))
+
+        # First discovery, then a discovery without the first bridge, then with it again
+        remembered = rememberBridges([], found)
+        first = addresses(remembered)
+        checks.check('each bridge gets its own node address', len(set(first.values())) == len(macs),
+                     ', '.join(sorted(first.values())))
+        remembered = rememberBridges(remembered, discover(emulators[1:], args.timeout))
+        checks.check('a bridge not answering keeps its node address', addresses(remembered) == first)
+        remembered = rememberBridges(remembered, discover(emulators, args.timeout))
+        checks.check('a bridge answering again keeps its node address', addresses(remembered) == first)
+
+        # A bridge changing IP, a new bridge appearing
+        for entry in remembered:
+            entry[1] = '192.0.2.1'
+        extra = BridgeEmulator(mac=b'\xac\xcf\x23\x00\x00\xff', discoveryPort=0).start()
+        try:
+            remembered = rememberBridges(remembered, discover([extra] + emulators, args.timeout))
+        finally:
+            extra.stop()
+        checks.check('a bridge changing IP keeps its node address',
+                     all(addresses(remembered)[mac] == first[mac] for mac in macs) and
+                     all(ip == emulators[0].host for mac, ip, address in remembered))
+        newAddresses = [address for mac, ip, address in remembered if mac not in first]
+        checks.check('a new bridge gets a new node address', len(newAddresses) == 1 and
+                     newAddresses[0] not in first.values(), ', '.join(newAddresses))
+
+        # Bridges remembered as [mac, ip] by older versions
+        legacy = [[mac, ip] for mac, ip, address in rememberBridges([], found)]
+        upgraded = rememberBridges(legacy, [])
+        checks.check('remembered bridges without node address get one', all(len(entry) == 3 for entry in upgraded)
+                     and len(set(addresses(upgraded).values())) == len(legacy))
+    finally:
+        for emulator in emulators:
+            emulator.stop()
+
+    print('{} check(s) failed'.format(checks.failed))
+    sys.exit(1 if checks.failed > 0 else 0)
+
+if __name__ == '__main__':
+    main()
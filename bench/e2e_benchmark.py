@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+
+"""
+End-to-end throughput and latency benchmark against emulated bridges (see bridge_emulator.py).
+
+N bridges x M zones are driven through:
+  - sync: MilightWifiBridge public functions, one blocking request at a time per bridge
+  - pipelined: MilightWifiBridge.sendRequests() with the commands of each round in flight together
+  - async: AsyncMilightWifiBridge.sendRequests(), every bridge driven by one event loop
+  - dispatch: the per-bridge dispatchers used by the NodeServer handlers (milight_bridges), latency is
+              measured from the handler queuing the command to the ACK callback
+
+Usage: python3 bench/e2e_benchmark.py --bridges 4 --zones 4 --rounds 50 --latency 0.005 --loss 0.01
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from MilightWifiBridge import MilightWifiBridge, AsyncMilightWifiBridge
+from milight_bridges import BridgeClientRegistry, BridgeCommand
+from bridge_emulator import BridgeEmulator
+
+
+MODES = ('sync', 'pipelined', 'async', 'dispatch')
+
+# Commands of one round, sent to every zone
+ROUND = (('turnOn', None), ('setColor', 0x7A), ('setBrightness', 80), ('setSaturation', 50))
+
+def percentile(values, p):
+    if len(values) == 0:
+        return float('nan')
+    ordered = sorted(values)
+    return ordered[max(0, int(math.ceil(p / 100.0 * len(ordered))) - 1)]
+
+def roundCommands(zones, step):
+    """Commands of a round, the values change at each round so no layer can skip them"""
+    commands = []
+    for zoneId in range(1, zones + 1):
+        for action, value in ROUND:
+            if value is not None:
+                value = (value + step) % 100
+            commands.append((action, value, zoneId))
+    return commands
+
+def runSync(emulators, args):
+    latencies = []
+    lock = threading.Lock()
+
+    def drive(emulator):
+        milight = MilightWifiBridge()
+        milight.setup(emulator.host, emulator.port, args.timeout)
+        for step in range(args.rounds):
+            for action, value, zoneId in roundCommands(args.zones, step):
+                start = time.perf_counter()
+                if value is None:
+                    result = getattr(milight, action)(zoneId)
+                else:
+                    result = getattr(milight, action)(value, zoneId)
+                elapsed = time.perf_counter() - start
+                with lock:
+                    latencies.append(elapsed if result else None)
+        milight.close()
+
+    return runThreads(drive, emulators), latencies
+
+def runPipelined(emulators, args):
+    latencies = []
+    lock = threading.Lock()
+
+    def drive(emulator):
+        milight = MilightWifiBridge()
+        milight.setup(emulator.host, emulator.port, args.timeout)
+        for step in range(args.rounds):
+            requests = [(MilightWifiBridge.getCommand(action, value), zoneId)
+                        for action, value, zoneId in roundCommands(args.zones, step)]
+            start = time.perf_counter()
+            results = milight.sendRequests(requests, args.window)
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.extend(elapsed if result else None for result in results)
+        milight.close()
+
+    return runThreads(drive, emulators), latencies
+
+def runAsync(emulators, args):
+    latencies = []
+
+    async def drive(emulator):
+        milight = AsyncMilightWifiBridge()
+        await milight.setup(emulator.host, emulator.port, args.timeout)
+        for step in range(args.rounds):
+            requests = [(MilightWifiBridge.getCommand(action, value), zoneId)
+                        for action, value, zoneId in roundCommands(args.zones, step)]
+            start = time.perf_counter()
+            results = await milight.sendRequests(requests, args.window)
+            elapsed = time.perf_counter() - start
+            latencies.extend(elapsed if result else None for result in results)
+        milight.close()
+
+    async def driveAll():
+        await asyncio.gather(*[drive(emulator) for emulator in emulators])
+
+    loop = asyncio.new_event_loop()
+    try:
+        start = time.perf_counter()
+        loop.run_until_complete(driveAll())
+        return time.perf_counter() - start, latencies
+    finally:
+        loop.close()
+
+def runDispatch(emulators, args):
+    registry = BridgeClientRegistry(maxDepth=args.rounds * args.zones * len(ROUND), coalesceWindow=0,
+                                    refreshInterval=0, frameRate=0)
+    latencies = []
+    lock = threading.Lock()
+    done = threading.Semaphore(0)
+    total = [0]
+
+    def acked(start):
+        def onSuccess():
+            with lock:
+                latencies.append(time.perf_counter() - start)
+            done.release()
+        return onSuccess
+
+    clients = [registry.acquire(emulator.host, emulator.port, args.timeout) for emulator in emulators]
+    start = time.perf_counter()
+    for step in range(args.rounds):
+        for client in clients:
+            for action, value, zoneId in roundCommands(args.zones, step):
+                queuedAt = time.perf_counter()
+                if client.submit(BridgeCommand(action, value, zoneId, acked(queuedAt), action)):
+                    total[0] += 1
+        if args.interval > 0:
+            time.sleep(args.interval)
+    deadline = time.monotonic() + args.timeout * 2
+    for _ in range(total[0]):
+        if not done.acquire(timeout=max(0.0, deadline - time.monotonic())):
+            break
+    elapsed = time.perf_counter() - start
+    registry.closeAll()
+    latencies.extend([None] * (total[0] - len(latencies)))
+    return elapsed, latencies
+
+def runThreads(drive, emulators):
+    threads = [threading.Thread(target=drive, args=(emulator,)) for emulator in emulators]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start
+
+def report(mode, elapsed, latencies):
+    succeeded = [latency for latency in latencies if latency is not None]
+    return {
+        'mode': mode,
+        'commands': len(latencies),
+        'failed': len(latencies) - len(succeeded),
+        'elapsed_sec': elapsed,
+        'commands_per_sec': len(succeeded) / elapsed if elapsed > 0 else float('nan'),
+        'p50_ms': percentile(succeeded, 50) * 1000.0,
+        'p95_ms': percentile(succeeded, 95) * 1000.0,
+        'p99_ms': percentile(succeeded, 99) * 1000.0,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark MilightWifiBridge and the NodeServer dispatchers '
+                                                 'against emulated bridges')
+    parser.add_argument('--bridges', type=int, default=4, help='number of emulated bridges (N)')
+    parser.add_argument('--zones', type=int, default=4, help='zones driven per bridge (M, 1 to 4)')
+    parser.add_argument('--rounds', type=int, default=25, help='rounds of on/color/brightness/saturation per zone')
+    parser.add_argument('--mode', choices=MODES + ('all',), default='all')
+    parser.add_argument('--latency', type=float, default=0.005, help='emulated bridge latency in sec')
+    parser.add_argument('--jitter', type=float, default=0.001, help='emulated latency variation in sec')
+    parser.add_argument('--loss', type=float, default=0.0, help='emulated probability a frame is lost')
+    parser.add_argument('--reorder', type=float, default=0.0, help='emulated probability an answer is reordered')
+    parser.add_argument('--timeout', type=float, default=5.0, help='client timeout in sec')
+    parser.add_argument('--window', type=int, default=16, help='in-flight window of the pipelined and async modes')
+    parser.add_argument('--interval', type=float, default=0.0, help='pause in sec between dispatch rounds')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+    args.zones = max(1, min(args.zones, 4))
+
+    results = []
+    for mode in (MODES if args.mode == 'all' else (args.mode,)):
+        emulators = [BridgeEmulator(latency=args.latency, jitter=args.jitter, loss=args.loss,
+                                    reorder=args.reorder, seed=index).start() for index in range(args.bridges)]
+        try:
+            elapsed, latencies = {'sync': runSync, 'pipelined': runPipelined, 'async': runAsync,
+                              'dispatch': runDispatch}[mode](emulators, args)
+        finally:
+            for emulator in emulators:
+                emulator.stop()
+        results.append(report(mode, elapsed, latencies))
+
+    print('{} bridges x {} zones, {} rounds, latency {} ms, jitter {} ms, loss {}%'.format(
+        args.bridges, args.zones, args.rounds, args.latency * 1000, args.jitter * 1000, args.loss * 100))
+    print('{:<10} {:>9} {:>7} {:>12} {:>9} {:>9} {:>9}'.format('mode', 'commands', 'failed', 'commands/s',
+                                                             'p50 ms', 'p95 ms', 'p99 ms'))
+    for result in results:
+        print('{mode:<10} {commands:>9} {failed:>7} {commands_per_sec:>12.1f} {p50_ms:>9.2f} {p95_ms:>9.2f} '
+              '{p99_ms:>9.2f}'.format(**result))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'arguments': vars(args), 'results': results}, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+
+"""
+Microbenchmarks of the pure CPU paths of MilightWifiBridge and of the NodeServer handlers.
+
+Each case is timed in isolation (best of several repeats) and reported in nanoseconds per call. The
+results can be saved as a JSON baseline and later runs compared to it, a case slower than the baseline
+by more than the threshold is flagged and makes the run exit with status 1.
+
+Usage:
+  python3 bench/micro_benchmark.py --save bench_baseline.json
+  python3 bench/micro_benchmark.py --compare bench_baseline.json --threshold 0.15
+"""
+
+import argparse
+import collections
+import json
+import os
+import platform
+import socket
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from MilightWifiBridge import MilightWifiBridge
+from milight_scenes import colorValue, whiteTemperature
+
+
+START_SESSION_RESPONSE = bytes([0x28, 0x00, 0x00, 0x00, 0x11, 0x00, 0x02, 0xAC, 0xCF, 0x23, 0xF5, 0x7A, 0xD4,
+                                0x69, 0xF0, 0x3C, 0x23, 0x00, 0x01, 0x12, 0x34, 0x00])
+
+class StubSocket(object):
+    """Socket answering every start session and request frame immediately, without any I/O"""
+
+    def __init__(self):
+        self.__answers = collections.deque()
+
+    def sendto(self, data, address):
+        if len(data) == 22:
+            self.__answers.append(bytes([0x88, 0x00, 0x00, 0x00, 0x03, 0x00, data[8], 0x00]))
+        else:
+            self.__answers.append(START_SESSION_RESPONSE)
+        return len(data)
+
+    def send(self, data):
+        return self.sendto(data, None)
+
+    def recvfrom(self, size):
+        return (self.recv(size), None)
+
+    def recv(self, size):
+        if len(self.__answers) == 0:
+            raise socket.timeout()
+        return self.__answers.popleft()
+
+    def settimeout(self, timeout):
+        pass
+
+    def shutdown(self, how):
+        pass
+
+    def close(self):
+        pass
+
+def private(name):
+    return getattr(MilightWifiBridge, '_MilightWifiBridge__' + name)
+
+def stubbedClient():
+    milight = MilightWifiBridge()
+    milight.setup('127.0.0.1', 5987, 1.0)
+    milight._MilightWifiBridge__sock.close()
+    milight._MilightWifiBridge__sock = StubSocket()
+    return milight
+
+def cases():
+    """Benchmark cases: name -> function called without argument"""
+    getSetColorCmd = private('getSetColorCmd')
+    getSetBridgeLampColorCmd = private('getSetBridgeLampColorCmd')
+    getSetBrightnessCmd = private('getSetBrightnessCmd')
+    getSetBrightnessForBridgeLampCmd = private('getSetBrightnessForBridgeLampCmd')
+    getSetSaturationCmd = private('getSetSaturationCmd')
+    getSetTemperatureCmd = private('getSetTemperatureCmd')
+    getSetDiscoModeCmd = private('getSetDiscoModeCmd')
+    getSetDiscoModeForBridgeLampCmd = private('getSetDiscoModeForBridgeLampCmd')
+    calculateCheckSum = private('calculateCheckSum')
+    command = MilightWifiBridge.getCommand('setColor', 0x7A)
+    requests = [(MilightWifiBridge.getCommand(action, value), zoneId) for zoneId in range(1, 5)
+                for action, value in (('turnOn', None), ('setColor', 0x7A), ('setBrightness', 80),
+                                      ('setSaturation', 50))]
+    milight = stubbedClient()
+    colorCommand = {'value': '3'}
+    tempCommand = {'value': '4'}
+
+    return {
+        'getSetColorCmd': lambda: getSetColorCmd(0x7A),
+        'getSetBridgeLampColorCmd': lambda: getSetBridgeLampColorCmd(0x7A),
+        'getSetBrightnessCmd': lambda: getSetBrightnessCmd(80),
+        'getSetBrightnessForBridgeLampCmd': lambda: getSetBrightnessForBridgeLampCmd(80),
+        'getSetSaturationCmd': lambda: getSetSaturationCmd(50),
+        'getSetTemperatureCmd': lambda: getSetTemperatureCmd(35),
+        'getSetDiscoModeCmd': lambda: getSetDiscoModeCmd(5),
+        'getSetDiscoModeForBridgeLampCmd': lambda: getSetDiscoModeForBridgeLampCmd(5),
+        'getCommand': lambda: MilightWifiBridge.getCommand('setBrightness', 80),
+        'calculateCheckSum': lambda: calculateCheckSum(command, 3),
+        'getRequestFrame': lambda: MilightWifiBridge.getRequestFrame(command, 3, 0x12, 0x34, 7),
+        'sendRequest (stubbed socket)': lambda: milight.setBrightness(80, 3),
+        'sendRequests x16 (stubbed socket)': lambda: milight.sendRequests(requests),
+        'parseStartSessionResponse': lambda: MilightWifiBridge.parseStartSessionResponse(START_SESSION_RESPONSE),
+        'COLOR_VALUE mapping': lambda: colorValue(colorCommand.get('value')),
+        'WHITE_TEMP mapping': lambda: whiteTemperature(tempCommand.get('value')),
+    }
+
+def measure(function, repeat, minTime):
+    """Give the best time in ns of one call to function"""
+    timer = timeit.Timer(function)
+    number = 1
+    while timer.timeit(number) < minTime:
+        number *= 2
+    best = min(timer.repeat(repeat=repeat, number=number))
+    return best / number * 1e9
+
+def compare(results, baseline, threshold):
+    """Print the comparison with a baseline, give the names of the regressed cases"""
+    regressions = []
+    print('{:<36} {:>12} {:>12} {:>8}'.format('case', 'baseline ns', 'current ns', 'change'))
+    for name, current in results.items():
+        previous = baseline.get(name)
+        if previous is None:
+            print('{:<36} {:>12} {:>12.1f} {:>8}'.format(name, '-', current, 'new'))
+            continue
+        change = (current - previous) / previous
+        flag = ''
+        if change > threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print('{:<36} {:>12.1f} {:>12.1f} {:>+7.1f}%{}'.format(name, previous, current, change * 100.0, flag))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Microbenchmarks of the MilightWifiBridge encode/parse paths')
+    parser.add_argument('--save', help='write the results as a JSON baseline to this file')
+    parser.add_argument('--compare', help='compare the results with this JSON baseline')
+    parser.add_argument('--threshold', type=float, default=0.15,
+                        help='relative slowdown flagged as a regression (default 0.15 = 15%%)')
+    parser.add_argument('--repeat', type=int, default=5, help='number of timed repeats per case')
+    parser.add_argument('--min-time', type=float, default=0.1, help='minimum duration in sec of one repeat')
+    parser.add_argument('--filter', default='', help='only run the cases containing this text')
+    args = parser.parse_args()
+
+    results = {}
+    for name, function in cases().items():
+        if args.filter in name:
+            results[name] = measure(function, args.repeat, args.min_time)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.threshold)
+    else:
+        regressions = []
+        print('{:<36} {:>12}'.format('case', 'ns/call'))
+        for name, result in results.items():
+            print('{:<36} {:>12.1f}'.format(name, result))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'python': platform.python_version(), 'machine': platform.machine(), 'results': results},
+                      f, indent=2, sort_keys=True)
+
+    if len(regressions) > 0:
+        print('{} regression(s) above {:.0f}%: {}'.format(len(regressions), args.threshold * 100.0,
+                                                         ', '.join(regressions)))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,881 @@
+#!/usr/bin/env python3
+
+"""
+Shared access to the MiLight wifi bridges used by the MiLight NodeServer.
+
+Every node of a bridge (the iBox lamp and its four zones) talks to the bridge through the same
+MilightWifiBridge client, so each bridge sees a single socket, a single session and a single
+sequence number space no matter how many nodes drive it.
+
+Node commands are not sent from the polyinterface callbacks: they are queued on the dispatcher of
+their bridge, which sends them in the background and reports the drivers once the bridge ACKed them.
+
+Fades are stepped by the fade scheduler of their bridge, within a frame budget shared by every fade
+of the bridge (see FadeScheduler).
+"""
+
+import logging
+import threading
+import time
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from MilightWifiBridge import MilightWifiBridge
+
+
+LOGGER = logging.getLogger(__name__)
+
+# Zone ID of the commands sent to the bridge lamp (MilightWifiBridge sends them to zone 1)
+BRIDGE_LAMP_ZONE = 0x01
+
+# Zone ID addressing every zone of a bridge, and the zones it stands for
+ALL_ZONES = MilightWifiBridge.eZone.ALL
+ZONES = (MilightWifiBridge.eZone.ONE, MilightWifiBridge.eZone.TWO, MilightWifiBridge.eZone.THREE,
+         MilightWifiBridge.eZone.FOUR)
+
+# Commands setting a level: a newer value of the same command for the same zone replaces a queued one
+COALESCED_ACTIONS = frozenset(['setColor', 'setBrightness', 'setSaturation', 'setTemperature', 'setDiscoMode',
+                               'setColorBridgeLamp', 'setBrightnessBridgeLamp', 'setDiscoModeBridgeLamp'])
+
+# Zone commands the bridge applies the same way to every zone when sent to ALL_ZONES
+ALL_ZONES_ACTIONS = frozenset(['turnOn', 'turnOff', 'setNightMode', 'setWhiteMode', 'setDiscoMode', 'speedUpDiscoMode',
+                               'slowDownDiscoMode', 'setColor', 'setBrightness', 'setSaturation', 'setTemperature'])
+
+# State of a zone set by each action: action -> (attribute, value, mode), a value of None stands for the value
+# of the command and mode is the mode (color, white, ...) the bulb switches to
+ACTION_STATES = {
+    'turnOn': ('power', 1, None),
+    'turnOff': ('power', 0, None),
+    'setColor': ('color', None, 'color'),
+    'setSaturation': ('saturation', None, 'color'),
+    'setTemperature': ('temperature', None, 'white'),
+    'setWhiteMode': ('mode', 'white', 'white'),
+    'setNightMode': ('mode', 'night', 'night'),
+    'setDiscoMode': ('effect', None, 'disco'),
+    'setBrightness': ('brightness', None, None),
+    'turnOnWifiBridgeLamp': ('power', 1, None),
+    'turnOffWifiBridgeLamp': ('power', 0, None),
+    'setColorBridgeLamp': ('color', None, 'color'),
+    'setWhiteModeBridgeLamp': ('mode', 'white', 'white'),
+    'setDiscoModeBridgeLamp': ('effect', None, 'disco'),
+    'setBrightnessBridgeLamp': ('brightness', None, None),
+}
+
+# Priority classes of the commands: the dispatcher of a bridge sends the queued commands of a class before
+# those of the next classes
+PRIORITY_SWITCH = 0 # Interactive on/off
+PRIORITY_LEVEL = 1 # Interactive level, mode or effect
+PRIORITY_SCENE = 2 # Scenes
+PRIORITY_BACKGROUND = 3 # Fades
+PRIORITIES = (PRIORITY_SWITCH, PRIORITY_LEVEL, PRIORITY_SCENE, PRIORITY_BACKGROUND)
+
+# Commands of the PRIORITY_SWITCH class when no priority is given
+SWITCH_ACTIONS = frozenset(['turnOn', 'turnOff', 'turnOnWifiBridgeLamp', 'turnOffWifiBridgeLamp'])
+
+# Most frames of a class sent per batch, so an interactive command never waits behind a long batch (the
+# same command for the four zones counts as one frame, see collapseZones())
+BATCH_LIMITS = {PRIORITY_SCENE: 16, PRIORITY_BACKGROUND: 4}
+
+# Node address prefix of the bridges found by the LAN discovery (see rememberBridges())
+DISCOVERED_PREFIX = 'ibox'
+
+class BridgeCommand(object):
+    """Command waiting to be sent to a bridge
+
+    action is the name of the MilightWifiBridge function (see MilightWifiBridge.getCommand()),
+    onSuccess is called from the dispatcher thread once the bridge ACKed the command. A command not
+    waiting for its ACK (waitAck False, the steps of a fade) is sent once and never retried. priority
+    is one of PRIORITIES (default: PRIORITY_SWITCH for SWITCH_ACTIONS, else PRIORITY_LEVEL).
+    """
+    __slots__ = ('action', 'value', 'zoneId', 'onSuccess', 'description', 'waitAck', 'priority', 'deadline',
+                 'queuedAt', 'generation', 'merged')
+
+    def __init__(self, action, value, zoneId, onSuccess=None, description='', waitAck=True, priority=None):
+        self.action = action
+        self.value = value
+        self.zoneId = zoneId
+        self.onSuccess = onSuccess
+        self.description = description
+        self.waitAck = waitAck
+        if priority is None:
+            priority = PRIORITY_SWITCH if action in SWITCH_ACTIONS else PRIORITY_LEVEL
+        self.priority = priority
+        self.deadline = None
+        self.queuedAt = None
+        self.generation = None # Set by ZoneStateCache.invalidate()
+        self.merged = None # Commands this one sends to ALL_ZONES at once (see collapseZones())
+
+    def request(self):
+        return (MilightWifiBridge.getCommand(self.action, self.value), self.zoneId)
+
+def _targets(command):
+    """Give what a command changes: 'lamp' for the bridge lamp, else the zones"""
+    if command.action.endswith('BridgeLamp'):
+        return ('lamp',)
+    if command.zoneId == ALL_ZONES:
+        return ZONES
+    return (command.zoneId,)
+
+def collapseZones(commands):
+    """Replace the same command queued for the four zones of a bridge by one command for ALL_ZONES
+
+    Commands for different zones do not depend on each other, so only the order of the commands of each
+    zone is kept: the zones are walked together and whenever their next commands are the same, they are
+    sent once to ALL_ZONES. Commands for other zone IDs or for the bridge lamp are kept in place and the
+    zone commands are not moved across them.
+
+    Keyword arguments:
+      commands -- (list of BridgeCommand) Commands in queuing order
+
+    return: (list of BridgeCommand) Commands to send
+    """
+    collapsed = []
+    zones = dict((zoneId, collections.deque()) for zoneId in ZONES)
+    for command in commands:
+        if command.zoneId in zones and command.action in ALL_ZONES_ACTIONS:
+            zones[command.zoneId].append(command)
+        else:
+            _collapseQueued(zones, collapsed)
+            collapsed.append(command)
+    _collapseQueued(zones, collapsed)
+    return collapsed
+
+def _collapseQueued(zones, collapsed):
+    while True:
+        heads = [queue[0] for queue in zones.values() if len(queue) > 0]
+        if len(heads) == 0:
+            return
+        keys = [(head.action, head.value) for head in heads]
+        if len(heads) == len(ZONES) and keys.count(keys[0]) == len(keys):
+            commands = [queue.popleft() for queue in zones.values()]
+            collapsed.append(_allZonesCommand(commands))
+            continue
+        # Send the heads standing in the way of the most common one, it may then be next on every zone
+        common = max(keys, key=keys.count)
+        if keys.count(common) == len(keys):
+            # Some zone has nothing left: no more command can go to all the zones
+            remaining = [command for queue in zones.values() for command in queue]
+            for queue in zones.values():
+                queue.clear()
+            collapsed.extend(sorted(remaining, key=lambda command: command.queuedAt))
+            return
+        for queue, key in zip([queue for queue in zones.values() if len(queue) > 0], keys):
+            if key != common:
+                collapsed.append(queue.popleft())
+
+def _allZonesCommand(commands):
+    callbacks = [command.onSuccess for command in commands if command.onSuccess is not None]
+
+    def onSuccess():
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as ex:
+                LOGGER.error('Error updating a zone after %s: %s', command.description, str(ex), exc_info=True)
+    first = commands[0]
+    command = BridgeCommand(first.action, first.value, ALL_ZONES, onSuccess if len(callbacks) > 0 else None,
+                            ', '.join(command.description for command in commands),
+                            any(command.waitAck for command in commands), min(command.priority for command in commands))
+    command.deadline = min(command.deadline for command in commands)
+    command.queuedAt = min(command.queuedAt for command in commands)
+    command.generation = min(command.generation or 0 for command in commands)
+    command.merged = commands
+    return command
+
+class ZoneStateCache(object):
+    """Last state the zones (and the lamp) of a bridge ACKed, used to skip the commands changing nothing
+
+    A cached value is only trusted for refreshInterval sec after its ACK, so the commands are still sent
+    once in a while for the bulbs that missed a frame. Queuing a command forgets the cached values it may
+    change until it is ACKed, so a command is never skipped because of a state still being changed by
+    another command. The ACK of a command only records the values no command queued after it may change
+    (each queued command gets a generation), an older command ACKed late never brings back its value.
+    """
+
+    def __init__(self, refreshInterval=300.0):
+        self.refreshInterval = refreshInterval
+        self.__lock = threading.Lock()
+        self.__states = {} # (zone ID or 'lamp', attribute) -> (value, time of the ACK)
+        self.__generation = 0
+        self.__latest = {} # (zone ID or 'lamp', attribute or None for all) -> generation of the last command
+                           # queued that may change it
+
+    def isRedundant(self, command):
+        """Give whether the bridge already ACKed the state a command sets (less than refreshInterval ago)"""
+        state = ACTION_STATES.get(command.action)
+        if state is None or self.refreshInterval <= 0:
+            return False
+        attribute, value, mode = state
+        if value is None:
+            value = command.value
+        now = time.monotonic()
+        with self.__lock:
+            for target in _targets(command):
+                if not self.__matches(target, attribute, value, now):
+                    return False
+                if mode is not None and not self.__matches(target, 'mode', mode, now):
+                    return False
+        return True
+
+    def __matches(self, target, attribute, value, now):
+        entry = self.__states.get((target, attribute))
+        return entry is not None and entry[0] == value and now - entry[1] < self.refreshInterval
+
+    def invalidate(self, command):
+        """Forget the cached values a command about to be sent may change, until it is ACKed (see update())"""
+        self.__apply(command, False)
+
+    def update(self, command):
+        """Record the state set by a command the bridge ACKed"""
+        self.__apply(command, True)
+
+    def __apply(self, command, acked):
+        state = ACTION_STATES.get(command.action)
+        targets = _targets(command)
+        with self.__lock:
+            if not acked:
+                self.__generation += 1
+                command.generation = self.__generation
+            if state is None:
+                if command.action in ('link', 'unlink'):
+                    self.__forget(targets, lambda attribute: True)
+                    if not acked:
+                        self.__queued(targets, (None,), command)
+                return
+            attribute, value, mode = state
+            if value is None:
+                value = command.value
+            now = time.monotonic()
+            for target in targets:
+                currentMode = self.__states.get((target, 'mode'), (None,))[0]
+                # Leaving night mode or switching mode: the other cached values may not hold anymore
+                if (currentMode == 'night' and attribute != 'power') or (mode is not None and currentMode != mode):
+                    self.__forget((target,), lambda attribute: attribute != 'power')
+                    if not acked:
+                        self.__queued((target,), (None,), command)
+                # Level commands may turn the bulb on
+                if attribute != 'power':
+                    self.__states.pop((target, 'power'), None)
+                if not acked:
+                    attributes = (attribute, 'power', 'mode') if mode is not None else (attribute, 'power')
+                    self.__queued((target,), attributes, command)
+                    self.__states.pop((target, attribute), None)
+                    if mode is not None:
+                        self.__states.pop((target, 'mode'), None)
+                    continue
+                if mode is not None and self.__isLatest(target, 'mode', command):
+                    self.__states[(target, 'mode')] = (mode, now)
+                if self.__isLatest(target, attribute, command):
+                    self.__states[(target, attribute)] = (value, now)
+
+    def __queued(self, targets, attributes, command):
+        for target in targets:
+            for attribute in attributes:
+                self.__latest[(target, attribute)] = command.generation
+
+    def __isLatest(self, target, attribute, command):
+        # No command queued after this one may change the attribute
+        generation = command.generation or 0
+        return (self.__latest.get((target, attribute), 0) <= generation and
+                self.__latest.get((target, None), 0) <= generation)
+
+    def __forget(self, targets, attributes):
+        for key in [key for key in self.__states if key[0] in targets and attributes(key[1])]:
+            del self.__states[key]
+
+class BridgeDispatcher(object):
+    """Queue and background worker sending the commands of one bridge
+
+    Level commands (see COALESCED_ACTIONS) but the steps of a fade are held up to coalesceWindow sec: a
+    newer value for the same zone and command replaces the queued one as long as no other command for
+    that zone was queued after it, so dragging a slider only sends the values the bulb would not
+    overwrite right away.
+
+    The same command queued for the four zones is sent once to all of them (see collapseZones()).
+
+    Each priority class has its own queue and a batch only holds commands of the first class with
+    queued commands (see BATCH_LIMITS). The commands of a zone are still
+    sent in the order they were queued: a command moves the lower class commands queued before it for
+    the same zone to its own class, except those it supersedes (setting the same attribute, or not
+    waiting for their ACK such as the steps of a cancelled fade) which are dropped.
+    """
+
+    def __init__(self, client, maxDepth=64, commandTtl=10.0, coalesceWindow=0.1):
+        self.client = client
+        self.maxDepth = maxDepth
+        self.commandTtl = commandTtl
+        self.coalesceWindow = coalesceWindow
+        self.__queues = [collections.deque() for priority in PRIORITIES]
+        self.__lastQueued = {} # Targets (see _targets()) -> last command queued for them
+        self.__condition = threading.Condition()
+        self.__thread = None
+        self.__running = False
+
+    def submit(self, commands):
+        """Queue commands, they are sent in order by the worker thread
+
+        Keyword arguments:
+          commands -- (list of BridgeCommand) Commands to send
+
+        return: (bool) Commands queued (False if the queue is full)
+        """
+        now = time.monotonic()
+        with self.__condition:
+            if sum(len(queue) for queue in self.__queues) + len(commands) > self.maxDepth:
+                LOGGER.warning('Command queue of bridge %s is full, dropping %s', self.client.host,
+                               ', '.join(command.description for command in commands))
+                return False
+            for command in commands:
+                command.deadline = now + self.commandTtl
+                targets = _targets(command)
+                last = self.__lastQueued.get(targets)
+                if (command.action in COALESCED_ACTIONS and last is not None and last.action == command.action and
+                        last.priority == command.priority):
+                    LOGGER.debug('Coalescing %s (%s replaces %s)', command.description, command.value, last.value)
+                    last.value = command.value
+                    last.onSuccess = command.onSuccess
+                    last.description = command.description
+                    last.waitAck = command.waitAck
+                    last.deadline = command.deadline
+                    last.generation = command.generation
+                    continue
+                self.__preempt(command)
+                command.queuedAt = now
+                self.__queues[command.priority].append(command)
+                # A command queued after one for the same lamp or zone keeps it from being coalesced
+                for key in [key for key in self.__lastQueued if any(target in targets for target in key)]:
+                    del self.__lastQueued[key]
+                self.__lastQueued[targets] = command
+            if self.__thread is None:
+                self.__running = True
+                self.__thread = threading.Thread(target=self.__run, name='bridge-' + str(self.client.host))
+                self.__thread.daemon = True
+                self.__thread.start()
+            self.__condition.notify()
+        return True
+
+    def stop(self):
+        with self.__condition:
+            self.__running = False
+            for queue in self.__queues:
+                queue.clear()
+            self.__lastQueued.clear()
+            self.__thread = None
+            self.__condition.notify()
+
+    def __preempt(self, command):
+        """Move the lower class commands queued for the zones of a command to its class, or drop them"""
+        targets = _targets(command)
+        attribute = ACTION_STATES.get(command.action, (None,))[0]
+        for priority in PRIORITIES[command.priority + 1:]:
+            queue = self.__queues[priority]
+            if len(queue) == 0:
+                continue
+            kept = collections.deque()
+            for queued in queue:
+                queuedTargets = _targets(queued)
+                if not any(target in targets for target in queuedTargets):
+                    kept.append(queued)
+                    continue
+                superseded = not queued.waitAck or (attribute is not None and
+                                                    ACTION_STATES.get(queued.action, (None,))[0] == attribute)
+                if superseded and all(target in targets for target in queuedTargets):
+                    LOGGER.debug('Dropping %s, superseded by %s', queued.description, command.description)
+                    if self.__lastQueued.get(queuedTargets) is queued:
+                        del self.__lastQueued[queuedTargets]
+                    continue
+                # Queued before the command for the same zone: sent before it
+                queued.priority = command.priority
+                self.__queues[command.priority].append(queued)
+            self.__queues[priority] = kept
+
+    def __next(self):
+        """Wait for queued commands and take those of the first class with queued commands, None once stopped"""
+        with self.__condition:
+            while self.__running:
+                queue = next((queue for queue in self.__queues if len(queue) > 0), None)
+                if queue is None:
+                    self.__condition.wait()
+                    continue
+                # Only level commands queued: give the next values of a slider a chance to replace them (not
+                # the steps of a fade, already paced by the fade scheduler)
+                if self.coalesceWindow > 0 and all(command.waitAck and command.action in COALESCED_ACTIONS
+                                                   for command in queue):
+                    remaining = queue[0].queuedAt + self.coalesceWindow - time.monotonic()
+                    if remaining > 0:
+                        self.__condition.wait(remaining)
+                        continue
+                break
+            if not self.__running:
+                return None
+            index = self.__queues.index(queue)
+            limit = BATCH_LIMITS.get(index)
+            if limit is None or len(queue) <= limit:
+                commands = list(queue)
+                queue.clear()
+            else:
+                # Cut after limit frames, not commands: the zones of a scene are queued one after the other
+                taken = set()
+                for frame in collapseZones(list(queue))[:limit]:
+                    taken.update(id(command) for command in (frame.merged or (frame,)))
+                commands = [command for command in queue if id(command) in taken]
+                self.__queues[index] = collections.deque(command for command in queue if id(command) not in taken)
+            for command in commands:
+                if self.__lastQueued.get(_targets(command)) is command:
+                    del self.__lastQueued[_targets(command)]
+            return commands
+
+    def __run(self):
+        while True:
+            commands = self.__next()
+            if commands is None:
+                return
+            try:
+                self.__send(commands)
+            except Exception as ex:
+                LOGGER.error('Error sending commands to bridge %s: %s', self.client.host, str(ex), exc_info=True)
+            self.client.batchDone()
+
+    def __expired(self, commands):
+        now = time.monotonic()
+        for command in commands:
+            if command.deadline < now:
+                LOGGER.warning('Command expired before being sent: %s', command.description)
+        return [command for command in commands if command.deadline >= now]
+
+    def __send(self, commands):
+        commands = collapseZones(self.__expired(commands))
+        if len(commands) == 0:
+            return
+        if not self.client.connect():
+            failed = commands
+        else:
+            failed = self.__sendRequests(commands)
+
+        # Retry once on a fresh socket and session (not the fade steps, the next one supersedes them)
+        failed = [command for command in self.__expired(failed) if command.waitAck]
+        if len(failed) > 0:
+            if self.client.reconnect():
+                failed = self.__sendRequests(failed)
+            for command in failed:
+                LOGGER.warning('Unable to %s', command.description)
+
+    def __sendRequests(self, commands):
+        """Send commands in order, those not waiting for their ACK without waiting for it
+
+        return: (list of BridgeCommand) Commands that failed
+        """
+        failed = []
+        start = 0
+        while start < len(commands):
+            waitAck = commands[start].waitAck
+            end = start + 1
+            while end < len(commands) and commands[end].waitAck == waitAck:
+                end += 1
+            run = commands[start:end]
+            self.client.sent += len(run)
+            results = self.client.milight.sendRequests([command.request() for command in run], waitAck=waitAck)
+            if waitAck:
+                self.__succeeded([command for command, result in zip(run, results) if result])
+            failed.extend(command for command, result in zip(run, results) if not result)
+            start = end
+        return failed
+
+    def __succeeded(self, commands):
+        for command in commands:
+            self.client.stateCache.update(command)
+            if command.onSuccess is not None:
+                try:
+                    command.onSuccess()
+                except Exception as ex:
+                    LOGGER.error('Error updating %s: %s', command.description, str(ex), exc_info=True)
+
+class Fade(object):
+    """Level command moved step by step from a start value to an end value over duration sec
+
+    wrap is the size of a circular range (the color wheel) the fade goes around the shortest way, None
+    for a linear range. onDone is called with the value reached: the end value once the bridge ACKed it,
+    or the last value sent when the fade is cancelled.
+    """
+    __slots__ = ('action', 'zoneId', 'start', 'end', 'duration', 'onDone', 'description', 'wrap', 'targets',
+                 'startedAt', 'lastSent')
+
+    def __init__(self, action, zoneId, start, end, duration, onDone=None, description='', wrap=None):
+        self.action = action
+        self.zoneId = zoneId
+        self.start = start
+        self.end = end
+        self.duration = duration
+        self.onDone = onDone
+        self.description = description
+        self.wrap = wrap
+        self.targets = _targets(BridgeCommand(action, end, zoneId))
+        self.startedAt = None
+        self.lastSent = None
+
+    def valueAt(self, now):
+        progress = 1.0 if self.duration <= 0 else min(1.0, (now - self.startedAt) / self.duration)
+        delta = self.end - self.start
+        if self.wrap is None:
+            return int(round(self.start + delta * progress))
+        delta = (delta + self.wrap // 2) % self.wrap - self.wrap // 2
+        return int(round(self.start + delta * progress)) % self.wrap
+
+class FadeScheduler(object):
+    """Background worker stepping the fades of one bridge
+
+    Every frameRate-th of a sec, the next fade (in turn) whose value changed queues its new value on the
+    dispatcher without waiting for its ACK: the fades of a bridge share frameRate frames per sec and the
+    next step supersedes the last one anyway. The end value is queued as a regular command, the node
+    reports its driver once it is ACKed. Any command queued for the zone of a fade cancels the fade.
+    """
+
+    def __init__(self, client, frameRate=10.0):
+        self.client = client
+        self.frameRate = frameRate
+        self.__fades = [] # In turn order
+        self.__condition = threading.Condition()
+        self.__thread = None
+        self.__running = False
+
+    def start(self, fade):
+        """Start a fade, replacing the fade of the same zone"""
+        command = BridgeCommand(fade.action, fade.end, fade.zoneId)
+        # The cached state no longer holds once the first step is sent
+        self.client.stateCache.invalidate(command)
+        with self.__condition:
+            cancelled = self.__cancel(fade.targets)
+            fade.startedAt = time.monotonic()
+            self.__fades.append(fade)
+            if self.__thread is None:
+                self.__running = True
+                self.__thread = threading.Thread(target=self.__run, name='fades-' + str(self.client.host))
+                self.__thread.daemon = True
+                self.__thread.start()
+            self.__condition.notify()
+        self.__cancelled(cancelled)
+
+    def cancel(self, command):
+        """Cancel the fades of the zones a command changes"""
+        if len(self.__fades) == 0:
+            return
+        with self.__condition:
+            cancelled = self.__cancel(_targets(command))
+        self.__cancelled(cancelled)
+
+    def stop(self):
+        with self.__condition:
+            self.__running = False
+            self.__fades = []
+            self.__thread = None
+            self.__condition.notify()
+
+    def __cancel(self, targets):
+        cancelled = [fade for fade in self.__fades if any(target in targets for target in fade.targets)]
+        self.__fades = [fade for fade in self.__fades if fade not in cancelled]
+        return cancelled
+
+    def __cancelled(self, fades):
+        for fade in fades:
+            LOGGER.debug('Cancelled %s at %s', fade.description, fade.lastSent)
+            if fade.lastSent is not None:
+                self.__done(fade, fade.lastSent)
+
+    def __done(self, fade, value):
+        if fade.onDone is not None:
+            try:
+                fade.onDone(value)
+            except Exception as ex:
+                LOGGER.error('Error updating %s: %s', fade.description, str(ex), exc_info=True)
+
+    def __run(self):
+        nextFrameAt = 0.0
+        while True:
+            with self.__condition:
+                while self.__running and (len(self.__fades) == 0 or time.monotonic() < nextFrameAt):
+                    self.__condition.wait(None if len(self.__fades) == 0 else nextFrameAt - time.monotonic())
+                if not self.__running:
+                    return
+                now = time.monotonic()
+                finished = [fade for fade in self.__fades if now >= fade.startedAt + fade.duration]
+                self.__fades = [fade for fade in self.__fades if fade not in finished]
+                step = None
+                for fade in self.__fades:
+                    value = fade.valueAt(now)
+                    if value != fade.lastSent:
+                        # Queued under the lock: a command cancelling the fade is always queued after its steps
+                        self.__fades.remove(fade)
+                        self.__fades.append(fade)
+                        fade.lastSent = value
+                        step = BridgeCommand(fade.action, value, fade.zoneId, None, fade.description, False,
+                                             PRIORITY_BACKGROUND)
+                        self.client.dispatcher.submit([step])
+                        break
+                if step is not None:
+                    nextFrameAt = now + 1.0 / self.frameRate
+                for fade in finished:
+                    self.__finish(fade)
+
+    def __finish(self, fade):
+        # Straight to the dispatcher: BridgeClient.submit() would cancel a fade started since on the zone
+        command = BridgeCommand(fade.action, fade.end, fade.zoneId, lambda: self.__done(fade, fade.end),
+                                fade.description, priority=PRIORITY_BACKGROUND)
+        self.client.stateCache.invalidate(command)
+        self.client.dispatcher.submit([command])
+
+class BridgeClient(object):
+    """MilightWifiBridge client shared by all the nodes of one bridge"""
+
+    def __init__(self, host, port, timeout, sessionTtl, maxDepth=64, commandTtl=10.0, coalesceWindow=0.1,
+                 refreshInterval=300.0, fadeRate=10.0, frameRate=0.0, frameBurst=5):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.sessionTtl = sessionTtl
+        self.frameRate = frameRate # Frames sent per sec at most, every frame waits for a token (0 for no limit)
+        self.frameBurst = frameBurst
+        self.milight = MilightWifiBridge()
+        self.dispatcher = BridgeDispatcher(self, maxDepth, commandTtl, coalesceWindow)
+        self.fades = FadeScheduler(self, fadeRate)
+        self.stateCache = ZoneStateCache(refreshInterval)
+        self.sent = 0 # Commands sent to the bridge (retries included)
+        self.suppressed = 0 # Commands skipped because the bridge already ACKed the state they set
+        self.onBatchDone = None # Called once the callbacks of a batch of commands ran (to report the drivers)
+        self.connected = None # Result of the last check() (None before the first one)
+        self.refCount = 0
+        self.generation = 0
+        self.__lock = threading.Lock()
+
+    def submit(self, *commands):
+        """Queue commands on the dispatcher of the bridge (see BridgeDispatcher.submit())
+
+        The commands setting a state the bridge already ACKed are not queued, they succeed right away. A
+        command cancels the fades of its zones (see FadeScheduler).
+        """
+        queued = []
+        for command in commands:
+            self.fades.cancel(command)
+            if self.stateCache.isRedundant(command):
+                LOGGER.debug('Skipping %s, already done', command.description)
+                self.suppressed += 1
+                if command.onSuccess is not None:
+                    command.onSuccess()
+            else:
+                self.stateCache.invalidate(command)
+                queued.append(command)
+        if len(queued) < len(commands):
+            self.batchDone()
+        if len(queued) == 0:
+            return True
+        return self.dispatcher.submit(queued)
+
+    def batchDone(self):
+        if self.onBatchDone is not None:
+            try:
+                self.onBatchDone()
+            except Exception as ex:
+                LOGGER.error('Error after commands of bridge %s: %s', self.host, str(ex), exc_info=True)
+
+    def connect(self):
+        """Setup the client unless it is already connected
+
+        return: (bool) Client connected
+        """
+        with self.__lock:
+            if self.milight.isInitialized():
+                return True
+            return self.__setup()
+
+    def probe(self, timeout=None):
+        """Check the bridge answers by starting its session (or reusing the cached one)
+
+        Keyword arguments:
+          timeout -- (float, optional) Maximum time in sec to wait for the bridge (default: client timeout)
+
+        return: (string) MAC address of the bridge (empty if it did not answer)
+        """
+        if not self.connect():
+            return ''
+        return self.milight.getMacAddress(timeout)
+
+    def check(self, timeout=None):
+        """Check the bridge answers a new handshake on the current socket, rebuild the socket only if not
+
+        Keyword arguments:
+          timeout -- (float, optional) Maximum time in sec to wait for each handshake (default: client timeout)
+
+        return: (bool) Bridge connected
+        """
+        self.connected = self.connect() and self.milight.ping(timeout, fresh=True)
+        if not self.connected:
+            LOGGER.warning('MiLight bridge %s did not answer, rebuilding its socket', self.host)
+            self.connected = self.reconnect() and self.milight.ping(timeout, fresh=True)
+        return self.connected
+
+    def calibrate(self):
+        """Measure the frame rate the bridge handles (see MilightWifiBridge.calibrateFrameRate()) and use it
+
+        return: (float) Frame rate used (the configured one if the bridge lost frames at any rate)
+        """
+        if not self.connect():
+            return self.frameRate
+        frameRate = self.milight.calibrateFrameRate()
+        if frameRate > 0:
+            self.frameRate = frameRate
+            self.milight.setFrameRate(frameRate)
+        LOGGER.info('MiLight bridge %s limited to %.1f frames per sec', self.host, self.frameRate)
+        return self.frameRate
+
+    def reconnect(self):
+        """Rebuild the socket and session of the bridge
+
+        Several nodes of the same bridge usually notice a failure at the same time, the first one
+        reconnects and the others reuse the fresh connection instead of tearing it down again.
+
+        return: (bool) Client connected
+        """
+        generation = self.generation
+        with self.__lock:
+            if generation != self.generation and self.milight.isInitialized():
+                return True
+            return self.__setup()
+
+    def close(self):
+        self.fades.stop()
+        self.dispatcher.stop()
+        with self.__lock:
+            self.milight.close()
+
+    def __setup(self):
+        self.generation += 1
+        if self.milight.setup(self.host, self.port, self.timeout, self.sessionTtl, frame_rate=self.frameRate,
+                              frame_burst=self.frameBurst) == False:
+            LOGGER.error('Unable to setup MiLight bridge %s', self.host)
+            return False
+        return True
+
+class BridgeClientRegistry(object):
+    """Reference counted BridgeClient per bridge host and port"""
+
+    def __init__(self, sessionTtl=60.0, maxDepth=64, commandTtl=10.0, coalesceWindow=0.1, refreshInterval=300.0,
+                 fadeRate=10.0, frameRate=0.0, frameBurst=5):
+        self.sessionTtl = sessionTtl
+        self.maxDepth = maxDepth
+        self.commandTtl = commandTtl
+        self.coalesceWindow = coalesceWindow
+        self.refreshInterval = refreshInterval
+        self.fadeRate = fadeRate
+        self.frameRate = frameRate
+        self.frameBurst = frameBurst
+        self.onBatchDone = None
+        self.__lock = threading.Lock()
+        self.__clients = {}
+
+    def acquire(self, host, port, timeout):
+        """Give the client of a bridge, creating it on first use
+
+        Keyword arguments:
+          host -- (string) IP or host name of the bridge
+          port -- (int) UDP port of the bridge
+          timeout -- (float) Timeout in sec for the bridge to answer
+
+        return: (BridgeClient) Client shared by every node of the bridge
+        """
+        key = (host, int(port))
+        with self.__lock:
+            client = self.__clients.get(key)
+            if client is None:
+                client = BridgeClient(host, int(port), timeout, self.sessionTtl, self.maxDepth, self.commandTtl,
+                                      self.coalesceWindow, self.refreshInterval, self.fadeRate, self.frameRate,
+                                      self.frameBurst)
+                client.onBatchDone = self.onBatchDone
+                self.__clients[key] = client
+            client.refCount += 1
+            return client
+
+    def release(self, client):
+        """Drop one reference to a client, the last one closes it"""
+        with self.__lock:
+            client.refCount -= 1
+            if client.refCount > 0:
+                return
+            self.__clients.pop((client.host, client.port), None)
+        client.close()
+
+    def clients(self):
+        with self.__lock:
+            return list(self.__clients.values())
+
+    def closeAll(self):
+        with self.__lock:
+            clients = list(self.__clients.values())
+            self.__clients.clear()
+        for client in clients:
+            client.refCount = 0
+            client.close()
+
+def rememberBridges(known, bridges):
+    """Merge the bridges answering the discovery into the remembered ones
+
+    Each bridge is remembered by MAC address with a node address (DISCOVERED_PREFIX + number) given once:
+    it keeps it when its IP changes, when it does not answer and whatever the other bridges are.
+
+    Keyword arguments:
+      known -- (list of [mac, ip, address]) Remembered bridges ([mac, ip] entries get a node address)
+      bridges -- (list of MilightWifiBridge discovered bridge) Bridges answering the discovery
+
+    return: (list of [mac, ip, address]) Remembered bridges
+    """
+    remembered = [list(entry) for entry in known]
+    numbers = [int(entry[2][len(DISCOVERED_PREFIX):]) for entry in remembered if len(entry) > 2]
+    nextNumber = max(numbers + [0]) + 1
+    for entry in remembered:
+        if len(entry) < 3:
+            entry.append(DISCOVERED_PREFIX + str(nextNumber))
+            nextNumber += 1
+    macs = [entry[0] for entry in remembered]
+    for bridge in bridges:
+        if bridge.mac in macs:
+            remembered[macs.index(bridge.mac)][1] = bridge.ip
+        else:
+            remembered.append([bridge.mac, bridge.ip, DISCOVERED_PREFIX + str(nextNumber)])
+            macs.append(bridge.mac)
+            nextNumber += 1
+    return remembered
+
+def probeClients(clients, timeout=None):
+    """Probe bridges in parallel (see BridgeClient.probe()), a dead bridge does not delay the other ones
+
+    Keyword arguments:
+      clients -- (list of BridgeClient) Clients to probe
+      timeout -- (float, optional) Maximum time in sec to wait for each bridge
+
+    return: (list of string) MAC address of each bridge (empty if it did not answer)
+    """
+    return _inParallel(lambda client: client.probe(timeout), clients)
+
+def checkClients(clients, timeout=None):
+    """Check bridges in parallel (see BridgeClient.check())
+
+    Keyword arguments:
+      clients -- (list of BridgeClient) Clients to check
+      timeout -- (float, optional) Maximum time in sec to wait for each handshake
+
+    return: (list of bool) Each bridge connected
+    """
+    return _inParallel(lambda client: client.check(timeout), clients)
+
+def calibrateClients(clients):
+    """Calibrate the frame rate of bridges in parallel (see BridgeClient.calibrate())
+
+    Keyword arguments:
+      clients -- (list of BridgeClient) Clients to calibrate
+
+    return: (list of float) Frame rate used for each bridge
+    """
+    return _inParallel(lambda client: client.calibrate(), clients)
+
+def _inParallel(function, clients):
+    if len(clients) == 0:
+        return []
+    with ThreadPoolExecutor(max_workers=len(clients)) as executor:
+        return list(executor.map(function, clients))
@@ -9,9 +9,15 @@ MiLight functionality based on 'Milight-Wifi-Bridge-3.0-Python-Library' project
 import polyinterface
 import time
 import json
+import re
 import sys
+import threading
 from copy import deepcopy
 from MilightWifiBridge import MilightWifiBridge
+from milight_bridges import BridgeClientRegistry, BridgeCommand, Fade, BRIDGE_LAMP_ZONE
+from milight_bridges import calibrateClients, checkClients, probeClients, rememberBridges
+from milight_scenes import compileScenes, compileSteps, queueSteps, SceneTarget, ZONE_SCENE_ACTIONS, LAMP_SCENE_ACTIONS
+from milight_scenes import colorValue, whiteTemperature, COLOR_VALUE, WHITE_TEMP
 
 
 LOGGER = polyinterface.LOGGER
@@ -31,8 +37,8 @@ def get_profile_info(logger):
 
 class Controller(polyinterface.Controller):
 
-    COLOR_VALUE = [0x85,0xBA,0x7A,0xD9,0x54,0x1E,0xFF,0x3B]
-    WHITE_TEMP = [0,8,35,61,100]
+    COLOR_VALUE = COLOR_VALUE
+    WHITE_TEMP = WHITE_TEMP
 
     def __init__(self, polyglot):
         super(Controller, self).__init__(polyglot)
@@ -41,10 +47,30 @@ class Controller(polyinterface.Controller):
         self.queryON = False
         self.milight_host = ""
         self.milight_port = 5987
+        self.milight_timeout = 30.0
+        self.probe_timeout = 2.0
+        self.discovery = False
+        self.discovery_address = '255.255.255.255'
+        self.discovery_timeout = 2.0
+        self.calibrate_frame_rate = False
+        self.startedAt = None
         self.tries = 0
         self.hb = 0
+        self.bridgeClients = BridgeClientRegistry()
+        self.customData = None
+        self.customDataLock = threading.Lock()
+        self.sceneDefinitions = {}
+        self.scenes = {}
+        self.nodeStates = {}
+        self.nodeStatesLock = threading.Lock()
+        self.nodeStatesTimer = None
+        self.state_save_delay = 10.0
+        self.pendingNodes = set()
+        self.pendingNodesLock = threading.Lock()
+        self.bridgeClients.onBatchDone = self.flushDrivers
 
     def start(self):
+        self.startedAt = time.monotonic()
         LOGGER.info('Started MiLight for v2 NodeServer version %s', str(VERSION))
         self.setDriver('ST', 0)
         try:
@@ -58,31 +84,110 @@ class Controller(polyinterface.Controller):
             else:
                 self.milight_port = 5987
 
-            if self.milight_host == "" :
-                LOGGER.error('MiLight requires \'host\' parameters to be specified in custom configuration.')
+            if 'timeout' in self.polyConfig['customParams']:
+                self.milight_timeout = float(self.polyConfig['customParams']['timeout'])
+
+            if 'probe_timeout' in self.polyConfig['customParams']:
+                self.probe_timeout = float(self.polyConfig['customParams']['probe_timeout'])
+
+            if 'session_ttl' in self.polyConfig['customParams']:
+                self.bridgeClients.sessionTtl = float(self.polyConfig['customParams']['session_ttl'])
+
+            if 'queue_depth' in self.polyConfig['customParams']:
+                self.bridgeClients.maxDepth = int(self.polyConfig['customParams']['queue_depth'])
+
+            if 'command_ttl' in self.polyConfig['customParams']:
+                self.bridgeClients.commandTtl = float(self.polyConfig['customParams']['command_ttl'])
+
+            if 'coalesce_window' in self.polyConfig['customParams']:
+                self.bridgeClients.coalesceWindow = float(self.polyConfig['customParams']['coalesce_window'])
+
+            if 'state_save_delay' in self.polyConfig['customParams']:
+                self.state_save_delay = float(self.polyConfig['customParams']['state_save_delay'])
+
+            if 'refresh_interval' in self.polyConfig['customParams']:
+                self.bridgeClients.refreshInterval = float(self.polyConfig['customParams']['refresh_interval'])
+
+            if 'fade_rate' in self.polyConfig['customParams']:
+                self.bridgeClients.fadeRate = float(self.polyConfig['customParams']['fade_rate'])
+
+            if 'frame_rate' in self.polyConfig['customParams']:
+                if self.polyConfig['customParams']['frame_rate'].lower() == 'auto':
+                    self.calibrate_frame_rate = True
+                else:
+                    self.bridgeClients.frameRate = float(self.polyConfig['customParams']['frame_rate'])
+
+            if 'frame_burst' in self.polyConfig['customParams']:
+                self.bridgeClients.frameBurst = int(self.polyConfig['customParams']['frame_burst'])
+
+            if 'discovery' in self.polyConfig['customParams']:
+                self.discovery = self.polyConfig['customParams']['discovery'].lower() in ('1', 'true', 'yes', 'on')
+
+            if 'discovery_address' in self.polyConfig['customParams']:
+                self.discovery_address = self.polyConfig['customParams']['discovery_address']
+
+            if 'discovery_timeout' in self.polyConfig['customParams']:
+                self.discovery_timeout = float(self.polyConfig['customParams']['discovery_timeout'])
+
+            self.loadScenes()
+            self.nodeStates = self.getCustomData('node_states', {})
+
+            if self.milight_host == "" and not self.discovery:
+                LOGGER.error('MiLight requires \'host\' (or \'discovery\') parameters to be specified in '
+                             'custom configuration.')
                 return False
             else:
                 self.discover()
-                self.query()
+                if self.calibrate_frame_rate:
+                    # In the background, the calibration of an iBox takes a few sec (its commands wait meanwhile)
+                    calibration = threading.Thread(target=calibrateClients, args=(self.bridgeClients.clients(),),
+                                                   name='calibration')
+                    calibration.daemon = True
+                    calibration.start()
+                # The nodes restored their drivers, a full query would report all of them again
+                self.setDriver('ST', 1)
+                LOGGER.info('Ready in %.3f sec (%d nodes)', time.monotonic() - self.startedAt, len(self.nodes))
 
         except Exception as ex:
             LOGGER.error('Error starting MiLight NodeServer: %s', str(ex))
         self.check_profile()
         self.heartbeat()
 
+    def stop(self):
+        LOGGER.info('Stopping MiLight')
+        self.bridgeClients.closeAll()
+        self.saveNodeStates()
+
     def shortPoll(self):
-        pass
+        for node in self.nodes:
+            if hasattr(self.nodes[node], 'reportStatistics'):
+                self.nodes[node].reportStatistics()
+        self.flushDrivers()
 
     def longPoll(self):
         self.heartbeat()
 
     def query(self):
-        self.setDriver('ST', 1)
-        self.reportDrivers()
+        # Handshake with every bridge at once, on their current sockets
+        clients = self.bridgeClients.clients()
+        connected = checkClients(clients, self.probe_timeout)
+        self.setDriver('ST', 1 if all(connected) else 0)
         for node in self.nodes:
             if self.nodes[node].queryON == True :
-                self.nodes[node].query()
-            self.nodes[node].reportDrivers()
+                self.nodes[node].refresh()
+            self.nodes[node].flushDrivers()
+
+    def driversChanged(self, node):
+        with self.pendingNodesLock:
+            self.pendingNodes.add(node)
+
+    def flushDrivers(self):
+        # One report per node with the drivers changed since its last report
+        with self.pendingNodesLock:
+            nodes = list(self.pendingNodes)
+            self.pendingNodes.clear()
+        for node in nodes:
+            node.flushDrivers()
 
     def heartbeat(self):
         LOGGER.debug('heartbeat: hb={}'.format(self.hb))
@@ -94,16 +199,69 @@ class Controller(polyinterface.Controller):
             self.hb = 0
 
     def discover(self, *args, **kwargs):
-        time.sleep(1)
-        count = 1
-        for myHost in self.milight_host.split(','):
-            self.addNode(MiLightBridge(self, 'bridge' + str(count), 'bridge' + str(count), 'Bridge' + str(count), myHost, self.milight_port))
-            time.sleep(1)
-            self.addNode(MiLightLight(self, 'bridge' + str(count), 'bridge' + str(count) + '_zone1', 'Zone1', myHost, self.milight_port))
-            self.addNode(MiLightLight(self, 'bridge' + str(count), 'bridge' + str(count) + '_zone2', 'Zone2', myHost, self.milight_port))
-            self.addNode(MiLightLight(self, 'bridge' + str(count), 'bridge' + str(count) + '_zone3', 'Zone3', myHost, self.milight_port))
-            self.addNode(MiLightLight(self, 'bridge' + str(count), 'bridge' + str(count) + '_zone4', 'Zone4', myHost, self.milight_port))
-            count = count + 1
+        startedAt = time.monotonic()
+        hosts = [host.strip() for host in self.milight_host.split(',') if host.strip() != '']
+        manualCount = len(hosts)
+        # (node address, node name, host, MAC address): the bridges of host by position, the discovered ones
+        # with the node address remembered for their MAC address
+        bridges = [('bridge' + str(index), 'Bridge' + str(index), host, '') for index, host in enumerate(hosts, 1)]
+        if self.discovery:
+            bridges = bridges + [(address, 'iBox ' + mac, ip, mac) for mac, ip, address in self.discoverHosts()
+                                 if ip not in hosts]
+
+        # A discovered bridge may also be configured by host name, only the MAC address of the configured
+        # bridges tells: they are probed (all at once, a dead bridge only costs probe_timeout once) for it,
+        # otherwise sockets and sessions open on first use
+        clients = []
+        if len(bridges) > manualCount and manualCount > 0:
+            clients = [self.bridgeClients.acquire(host, self.milight_port, self.milight_timeout)
+                       for address, name, host, mac in bridges[:manualCount]]
+            macs = probeClients(clients, self.probe_timeout)
+            for host, mac in zip(hosts, macs):
+                if mac == '':
+                    LOGGER.warning('MiLight bridge %s did not answer', host)
+                else:
+                    LOGGER.info('MiLight bridge %s answered (MAC address %s)', host, mac)
+            manualMacs = set(mac for mac in macs if mac != '')
+            bridges = bridges[:manualCount] + [bridge for bridge in bridges[manualCount:] if bridge[3] not in manualMacs]
+
+        for bridge, name, myHost, mac in bridges:
+            if bridge not in self.nodes:
+                self.addNode(MiLightBridge(self, bridge, bridge, name, myHost, self.milight_port))
+            for zone in range(1, 5):
+                address = bridge + '_zone' + str(zone)
+                if address not in self.nodes:
+                    self.addNode(MiLightLight(self, bridge, address, 'Zone' + str(zone), myHost, self.milight_port))
+
+        # Groups: 'groupN' custom parameters listing node addresses (ex: group1 bridge1_zone1,bridge2_zone3)
+        for param in sorted(self.polyConfig['customParams']):
+            match = re.match(r'^group(\d+)$', param)
+            if match is None:
+                continue
+            address = 'group' + match.group(1)
+            members = [member.strip() for member in self.polyConfig['customParams'][param].split(',')
+                       if member.strip() != '']
+            if address in self.nodes:
+                self.nodes[address].members = members
+            else:
+                self.addNode(MiLightGroup(self, self.address, address, 'Group' + match.group(1), members))
+        self.compileScenes()
+
+        for client in clients:
+            self.bridgeClients.release(client)
+        LOGGER.info('Discovered %d bridge(s) in %.3f sec', len(bridges), time.monotonic() - startedAt)
+
+    def discoverHosts(self):
+        # Bridges answering the LAN discovery, the bridges found once are remembered (by MAC address) in the
+        # custom data so they keep their node address even when their IP changes or they do not answer
+        known = self.getCustomData('discovered_bridges', [])
+        bridges = MilightWifiBridge.discoverBridges(self.discovery_timeout, self.discovery_address)
+        for bridge in bridges:
+            LOGGER.info('Discovered MiLight bridge %s (MAC address %s)', bridge.ip, bridge.mac)
+        remembered = rememberBridges(known, bridges)
+        if remembered != known:
+            self.updateCustomData({'discovered_bridges': remembered})
+        return remembered
 
     def delete(self):
         LOGGER.info('Deleting MiLight')
@@ -121,8 +279,71 @@ class Controller(polyinterface.Controller):
             self.update_profile = True
             self.poly.installprofile()
         LOGGER.info('check_profile: update_profile={}'.format(self.update_profile))
-        cdata['profile_info'] = self.profile_info
-        self.saveCustomData(cdata)
+        self.updateCustomData({'profile_info': self.profile_info})
+
+    def updateCustomData(self, data):
+        # saveCustomData() replaces all the custom data, merge the keys with the ones already saved
+        with self.customDataLock:
+            if self.customData is None:
+                self.customData = deepcopy(self.polyConfig['customData'])
+            self.customData.update(data)
+            self.saveCustomData(deepcopy(self.customData))
+
+    def getCustomData(self, key, default=None):
+        with self.customDataLock:
+            data = self.customData if self.customData is not None else self.polyConfig['customData']
+            return deepcopy(data.get(key, default))
+
+    def saveDriver(self, address, driver, value):
+        # Node states are saved in the custom data at most once per state_save_delay
+        with self.nodeStatesLock:
+            state = self.nodeStates.setdefault(address, {})
+            if state.get(driver) == value:
+                return
+            state[driver] = value
+            if self.nodeStatesTimer is None:
+                self.nodeStatesTimer = threading.Timer(self.state_save_delay, self.saveNodeStates)
+                self.nodeStatesTimer.daemon = True
+                self.nodeStatesTimer.start()
+
+    def saveNodeStates(self):
+        with self.nodeStatesLock:
+            if self.nodeStatesTimer is None:
+                return
+            self.nodeStatesTimer.cancel()
+            self.nodeStatesTimer = None
+            nodeStates = deepcopy(self.nodeStates)
+        self.updateCustomData({'node_states': nodeStates})
+
+    def loadScenes(self):
+        # The 'scenes' custom parameter (JSON) replaces the scenes saved in the custom data
+        if 'scenes' in self.polyConfig['customParams']:
+            try:
+                self.sceneDefinitions = json.loads(self.polyConfig['customParams']['scenes'])
+            except ValueError as ex:
+                LOGGER.error('Invalid scenes parameter: %s', str(ex))
+                return
+            if self.sceneDefinitions != self.getCustomData('scenes'):
+                self.updateCustomData({'scenes': self.sceneDefinitions})
+        else:
+            self.sceneDefinitions = self.getCustomData('scenes', {})
+
+    def compileScenes(self):
+        targets = {}
+        for address in self.nodes:
+            if hasattr(self.nodes[address], 'sceneTarget'):
+                targets[address] = self.nodes[address].sceneTarget()
+        self.scenes = compileScenes(self.sceneDefinitions, targets)
+        LOGGER.info('Compiled %d scene(s)', len(self.scenes))
+
+    def runScene(self, command):
+        number = int(command.get('value'))
+        scene = self.scenes.get(number)
+        if scene is None:
+            LOGGER.error('Unknown scene %d', number)
+            return
+        LOGGER.info('Running scene %d (%s)', number, scene.name)
+        scene.run()
 
     def install_profile(self,command):
         LOGGER.info("install_profile:")
@@ -133,19 +354,71 @@ class Controller(polyinterface.Controller):
         'QUERY': query,
         'DISCOVER': discover,
         'INSTALL_PROFILE': install_profile,
+        'RUN_SCENE': runScene,
     }
     drivers = [{'driver': 'ST', 'value': 1, 'uom': 2}]
 
-class MiLightLight(polyinterface.Node):
+class MiLightNode(polyinterface.Node):
+    """Node whose drivers (initialDrivers) are saved in the custom data and restored at start"""
+
+    initialDrivers = {}
+
+    def __init__(self, controller, primary, address, name):
+        super(MiLightNode, self).__init__(controller, primary, address, name)
+        self.reportedDrivers = {} # Driver -> value last reported to the ISY
+
+    def setDriver(self, driver, value, report=True, force=False, uom=None):
+        super(MiLightNode, self).setDriver(driver, value, report, force, uom)
+        if driver in self.initialDrivers:
+            self.controller.saveDriver(self.address, driver, value)
+
+    def driverValue(self, driver):
+        # Value last set by setDriver(), getDriver() only gives the value Polyglot stored once it was reported
+        return next((entry['value'] for entry in self.drivers if entry['driver'] == driver), None)
+
+    def updateDriver(self, driver, value):
+        # Reported by the next flushDrivers() of the controller (after the batch of commands or poll cycle)
+        self.setDriver(driver, value, False)
+        self.controller.driversChanged(self)
+
+    def flushDrivers(self, force=False):
+        with self.controller.pendingNodesLock:
+            drivers = [driver for driver in self.drivers
+                       if force or self.reportedDrivers.get(driver['driver']) != driver['value']]
+            for driver in drivers:
+                self.reportedDrivers[driver['driver']] = driver['value']
+        for driver in drivers:
+            self.reportDriver(driver, True, force)
+
+    def check(self):
+        pass
+
+    def refresh(self):
+        pass
+
+    def query(self):
+        # Asked by the ISY: report every driver
+        self.check()
+        self.refresh()
+        self.flushDrivers(True)
+
+    def restoreDrivers(self):
+        # Not forced: only the drivers the ISY does not already know are reported
+        state = self.controller.nodeStates.get(self.address, {})
+        for driver, value in self.initialDrivers.items():
+            self.setDriver(driver, state.get(driver, value))
+            self.reportedDrivers[driver] = state.get(driver, value)
+
+class MiLightLight(MiLightNode):
 
     def __init__(self, controller, primary, address, name, bridge_host, bridge_port):
 
         super(MiLightLight, self).__init__(controller, primary, address, name)
         self.queryON = True
-        self.milight_timeout = 30.0
+        self.milight_timeout = controller.milight_timeout
         self.milight_host = bridge_host
         self.milight_port = bridge_port
-        self.myMilight = MilightWifiBridge()
+        self.bridgeClient = controller.bridgeClients.acquire(bridge_host, bridge_port, self.milight_timeout)
 
         # Set Zone
         if name == 'Zone1':
@@ -158,118 +431,79 @@ class MiLightLight(polyinterface.Node):
             self.grpNum = 4
 
     def start(self):
-        self.__ConnectWifiBridge()
-        self.setDriver('ST', 0, True)
-        self.setDriver('GV1', 0, True)
-        self.setDriver('GV2', 0, True)
-        self.setDriver('GV3', 100, True)
-        self.setDriver('GV4', 1, True)
-        self.setDriver('GV5', 0, True)
+        # The bridge client connects on the first command
+        self.restoreDrivers()
 
     def setOn(self, command):
-        if ( self.myMilight.turnOn(self.grpNum) == False ):
-            self.__ConnectWifiBridge()
-            if ( self.myMilight.turnOn(self.grpNum) == False ):
-                LOGGER.warning('Unable to Turn ON ' + self.name )
-            else:
-                self.setDriver('ST', 100,True)
-        else:
-            self.setDriver('ST', 100,True)
+        self.__send('Turn ON', 'turnOn', None, 'ST', 100)
 
     def setOff(self, command):
-        if (self.myMilight.turnOff(self.grpNum) == False):
-            self.__ConnectWifiBridge()
-            if (self.myMilight.turnOff(self.grpNum) == False):
-                LOGGER.warning('Unable to Turn OFF ' + self.name )
-            else:
-                self.setDriver('ST', 0,True)
-        else:
-            self.setDriver('ST', 0,True)
+        self.__send('Turn OFF', 'turnOff', None, 'ST', 0)
 
     def setColorID(self, command):
         intColor = int(command.get('value'))
-        if (self.myMilight.setColor(intColor,self.grpNum) == False):
-            self.__ConnectWifiBridge()
-            if (self.myMilight.setColor(intColor,self.grpNum) == False):
-                LOGGER.warning('Unable to SetColor ' + self.name )
-            else:
-                self.setDriver('GV1', intColor,True)
-        else:
-            self.setDriver('GV1', intColor,True)
+        self.__send('SetColor', 'setColor', intColor, 'GV1', intColor)
 
     def setColor(self, command):
-        intColor = self.parent.COLOR_VALUE[int(command.get('value'))-1]
-        if (self.myMilight.setColor(intColor,self.grpNum) == False):
-            self.__ConnectWifiBridge()
-            if (self.myMilight.setColor(intColor,self.grpNum) == False):
-                LOGGER.warning('Unable to SetColor ' + self.name )
-            else:
-                self.setDriver('GV1', intColor,True)
-        else:
-            self.setDriver('GV1', intColor,True)
+        intColor = colorValue(command.get('value'))
+        self.__send('SetColor', 'setColor', intColor, 'GV1', intColor)
 
     def setSaturation(self, command):
         intSat = int(command.get('value'))
-        if (self.myMilight.setSaturation(intSat,self.grpNum) == False):
-            self.__ConnectWifiBridge()
-            if (self.myMilight.setSaturation(intSat,self.grpNum) == False):
-                LOGGER.warning('Unable to setSaturation ' + self.name )
-            else:
-                self.setDriver('GV2', intSat,True)
-        else:
-            self.setDriver('GV2', intSat,True)
+        self.__send('setSaturation', 'setSaturation', intSat, 'GV2', intSat)
 
     def setBrightness(self, command):
         intBri = int(command.get('value'))
-        if (self.myMilight.setBrightness(intBri,self.grpNum)  == False):
-            self.__ConnectWifiBridge()
-            if (self.myMilight.setBrightness(intBri,self.grpNum)  == False):
-                LOGGER.warning('Unable to setBrightness ' + self.name )
-            else:
-                self.setDriver('GV3', intBri,True)
-        else:
-            self.setDriver('GV3', intBri,True)
+        self.__send('setBrightness', 'setBrightness', intBri, 'GV3', intBri)
 
     def setTempColor(self, command):
-        intTemp = self.parent.WHITE_TEMP[int(command.get('value'))-1]
-        if (self.myMilight.setTemperature(intTemp,self.grpNum) == False):
-            self.__ConnectWifiBridge()
-            if (self.myMilight.setTemperature(intTemp,self.grpNum) == False):
-                LOGGER.warning('Unable to setTemperature ' + self.name )
-            else:
-                self.setDriver('GV5', intTemp,True)
-        else:
-            self.setDriver('GV5', intTemp,True)
+        intTemp = whiteTemperature(command.get('value'))
+        self.__send('setTemperature', 'setTemperature', intTemp, 'GV5', intTemp)
 
     def setEffect(self, command):
         intEffect = int(command.get('value'))
-        if (self.myMilight.setDiscoMode(intEffect,self.grpNum) == False):
-            self.__ConnectWifiBridge()
-            if (self.myMilight.setDiscoMode(intEffect,self.grpNum) == False):
-                LOGGER.warning('Unable to setDiscoMode ' + self.name )
-            else:
-                self.setDriver('GV4', intEffect,True)
-        else:
-            self.setDriver('GV4', intEffect,True)
+        self.__send('setDiscoMode', 'setDiscoMode', intEffect, 'GV4', intEffect)
 
     def setWhiteMode(self, command):
-        if (self.myMilight.setWhiteMode(self.grpNum) == False):
-            self.__ConnectWifiBridge()
-            if (self.myMilight.setWhiteMode(self.grpNum) == False):
-                LOGGER.warning('Unable to setWhiteMode ' + self.name )
+        self.__send('setWhiteMode', 'setWhiteMode')
 
     def setNightMode(self, command):
-        if (self.myMilight.setNightMode(self.grpNum) == False):
-            self.__ConnectWifiBridge()
-            if (self.myMilight.setNightMode(self.grpNum) == False):
-                LOGGER.warning('Unable to setNightMode ' + self.name )
-
-    def __ConnectWifiBridge(self):
-        if ( self.myMilight.setup(self.milight_host,self.milight_port,self.milight_timeout) == False ):
-            LOGGER.error('Unable to setup MiLight')
-        
-    def query(self):
-        self.__ConnectWifiBridge()
+        self.__send('setNightMode', 'setNightMode')
+
+    def fadeBrightness(self, command):
+        intBri = int(command.get('query', {}).get('BR.uom51'))
+        self.__fade('fadeBrightness', 'setBrightness', 'GV3', intBri, command)
+
+    def fadeColor(self, command):
+        intColor = int(command.get('query', {}).get('CLR.uom100'))
+        self.__fade('fadeColor', 'setColor', 'GV1', intColor, command, 256)
+
+    def fadeTempColor(self, command):
+        intTemp = whiteTemperature(command.get('query', {}).get('K.uom25'))
+        self.__fade('fadeTemperature', 'setTemperature', 'GV5', intTemp, command)
+
+    def __send(self, description, action, value=None, driver=None, driverValue=None):
+        onSuccess = None
+        if driver is not None:
+            onSuccess = lambda: self.updateDriver(driver, driverValue)
+        self.bridgeClient.submit(BridgeCommand(action, value, self.grpNum, onSuccess, description + ' ' + self.name))
+
+    def __fade(self, description, action, driver, value, command, wrap=None):
+        # The steps are sent by the fade scheduler of the bridge, the driver is only reported at the end
+        duration = float(command.get('query', {}).get('DUR.uom58', 0))
+        start = int(float(self.driverValue(driver)))
+        if duration <= 0 or start == value:
+            self.__send(description, action, value, driver, value)
+            return
+        self.bridgeClient.fades.start(Fade(action, self.grpNum, start, value, duration,
+                                           lambda reached: self.updateDriver(driver, reached),
+                                           description + ' ' + self.name, wrap))
+
+    def sceneTarget(self):
+        return SceneTarget(self.name, self.bridgeClient, self.grpNum, ZONE_SCENE_ACTIONS, self.updateDriver)
+
+    def check(self):
+        self.bridgeClient.check(self.controller.probe_timeout)
 
     drivers = [{'driver': 'ST', 'value': 0, 'uom': 78},
                {'driver': 'GV1', 'value': 0, 'uom': 100},
@@ -278,6 +512,8 @@ class MiLightLight(polyinterface.Node):
                {'driver': 'GV5', 'value': 1, 'uom': 25},
                {'driver': 'GV4', 'value': 1, 'uom': 25}]
 
+    initialDrivers = {'ST': 0, 'GV1': 0, 'GV2': 0, 'GV3': 100, 'GV4': 1, 'GV5': 0}
+
     id = 'MILIGHT_LIGHT'
     commands = {
                     'DON': setOn,
@@ -289,110 +525,80 @@ class MiLightLight(polyinterface.Node):
                     "CLITEMP": setTempColor,
                     "SET_EFFECT": setEffect,
                     "WHITE_MODE": setWhiteMode,
-                    "NIGHT_MODE": setNightMode
+                    "NIGHT_MODE": setNightMode,
+                    "FADE_BRI": fadeBrightness,
+                    "FADE_COLOR": fadeColor,
+                    "FADE_TEMP": fadeTempColor
                 }
 
-class MiLightBridge(polyinterface.Node):
+class MiLightBridge(MiLightNode):
 
     def __init__(self, controller, primary, address, name, bridge_host, bridge_port):
 
         super(MiLightBridge, self).__init__(controller, primary, address, name)
         self.queryON = True
-        self.milight_timeout = 30.0
+        self.milight_timeout = controller.milight_timeout
         self.milight_host = bridge_host
         self.milight_port = bridge_port
-        self.myMilight = MilightWifiBridge()
+        self.bridgeClient = controller.bridgeClients.acquire(bridge_host, bridge_port, self.milight_timeout)
 
     def start(self):
-        self.__ConnectWifiBridge()
-
-        # Init Value
-        self.setDriver('ST', 0, True)
-        self.setDriver('GV1', 0, True)
-        self.setDriver('GV3', 100, True)
-        self.setDriver('GV4', 1, True)
+        # The bridge client connects on the first command
+        self.restoreDrivers()
 
     def setOn(self, command):
-        if ( self.myMilight.turnOnWifiBridgeLamp() == False ):
-            self.__ConnectWifiBridge()
-            if ( self.myMilight.turnOnWifiBridgeLamp() == False ):
-                LOGGER.warning('Unable to Turn ON Bridge Light')
-            else:
-                self.setDriver('ST', 100,True)
-        else:
-            self.setDriver('ST', 100,True)
+        self.__send('Turn ON Bridge Light', 'turnOnWifiBridgeLamp', None, 'ST', 100)
 
     def setOff(self, command):
-        if(self.myMilight.turnOffWifiBridgeLamp() == False):
-            self.__ConnectWifiBridge()
-            if(self.myMilight.turnOffWifiBridgeLamp() == False):
-                LOGGER.warning('Unable to Turn OFF Bridge Light')
-            else:
-                self.setDriver('ST', 0, True)
-        else:
-            self.setDriver('ST', 0, True)
+        self.__send('Turn OFF Bridge Light', 'turnOffWifiBridgeLamp', None, 'ST', 0)
 
     def setColorID(self, command):
         intColor = int(command.get('value'))
-        if (self.myMilight.setColorBridgeLamp(intColor) == False):
-            self.__ConnectWifiBridge()
-            if (self.myMilight.setColorBridgeLamp(intColor) == False):
-                LOGGER.warning('Unable to setColorBridgeLamp')
-            else:
-                self.setDriver('GV1', intColor,True)
-        else:
-            self.setDriver('GV1', intColor,True)
+        self.__send('setColorBridgeLamp', 'setColorBridgeLamp', intColor, 'GV1', intColor)
 
     def setColor(self, command):
-        intColor = self.parent.COLOR_VALUE[int(command.get('value'))-1]
-        if (self.myMilight.setColorBridgeLamp(intColor) == False):
-            self.__ConnectWifiBridge()
-            if (self.myMilight.setColorBridgeLamp(intColor) == False):
-                LOGGER.warning('Unable to SetColor ' + self.name )
-            else:
-                self.setDriver('GV1', intColor,True)
-        else:
-            self.setDriver('GV1', intColor,True)
+        intColor = colorValue(command.get('value'))
+        self.__send('SetColor ' + self.name, 'setColorBridgeLamp', intColor, 'GV1', intColor)
 
     def setBrightness(self, command):
         intBri = int(command.get('value'))
-        if (self.myMilight.setBrightnessBridgeLamp(intBri) == False):
-            self.__ConnectWifiBridge()
-            if (self.myMilight.setBrightnessBridgeLamp(intBri) == False):
-                LOGGER.warning('Unable to setBrightnessBridgeLamp')
-            else:
-                self.setDriver('GV3', intBri,True)
-        else:
-            self.setDriver('GV3', intBri,True)
+        self.__send('setBrightnessBridgeLamp', 'setBrightnessBridgeLamp', intBri, 'GV3', intBri)
 
     def setEffect(self, command):
         intEffect = int(command.get('value'))
-        if(self.myMilight.setDiscoModeBridgeLamp(intEffect) == False):
-            self.__ConnectWifiBridge()
-            if(self.myMilight.setDiscoModeBridgeLamp(intEffect) == False):
-                LOGGER.warning('Unable to setDiscoModeBridgeLamp')
-            else:
-                self.setDriver('GV4', intEffect,True)
-        else:
-            self.setDriver('GV4', intEffect,True)
+        self.__send('setDiscoModeBridgeLamp', 'setDiscoModeBridgeLamp', intEffect, 'GV4', intEffect)
 
     def setWhiteMode(self, command):
-        if (self.myMilight.setWhiteModeBridgeLamp() == False):
-            self.__ConnectWifiBridge()
-            if (self.myMilight.setWhiteModeBridgeLamp() == False):
-                LOGGER.warning('Unable to setWhiteModeBridgeLamp')
+        self.__send('setWhiteModeBridgeLamp', 'setWhiteModeBridgeLamp')
 
-    def __ConnectWifiBridge(self):
-        if ( self.myMilight.setup(self.milight_host,self.milight_port,self.milight_timeout) == False ):
-            LOGGER.error('Unable to setup MiLight')
+    def __send(self, description, action, value=None, driver=None, driverValue=None):
+        onSuccess = None
+        if driver is not None:
+            onSuccess = lambda: self.updateDriver(driver, driverValue)
+        self.bridgeClient.submit(BridgeCommand(action, value, BRIDGE_LAMP_ZONE, onSuccess, description))
 
-    def query(self):
-        self.__ConnectWifiBridge()
+    def sceneTarget(self):
+        return SceneTarget(self.name, self.bridgeClient, BRIDGE_LAMP_ZONE, LAMP_SCENE_ACTIONS, self.updateDriver)
+
+    def reportStatistics(self):
+        self.updateDriver('GV7', self.bridgeClient.sent)
+        self.updateDriver('GV8', self.bridgeClient.suppressed)
+
+    def check(self):
+        self.bridgeClient.check(self.controller.probe_timeout)
+
+    def refresh(self):
+        self.updateDriver('GV9', 1 if self.bridgeClient.connected else 0)
 
     drivers = [{'driver': 'ST', 'value': 0, 'uom': 78},
                {'driver': 'GV1', 'value': 0, 'uom': 100},
                {'driver': 'GV3', 'value': 0, 'uom': 51},
-               {'driver': 'GV4', 'value': 1, 'uom': 25}]
+               {'driver': 'GV4', 'value': 1, 'uom': 25},
+               {'driver': 'GV7', 'value': 0, 'uom': 56},
+               {'driver': 'GV8', 'value': 0, 'uom': 56},
+               {'driver': 'GV9', 'value': 0, 'uom': 2}]
+    initialDrivers = {'ST': 0, 'GV1': 0, 'GV3': 100, 'GV4': 1}
+
     id = 'MILIGHT_BRIDGE'
     commands = {
                     'DON': setOn,
@@ -404,6 +610,93 @@ class MiLightBridge(polyinterface.Node):
                     "WHITE_MODE": setWhiteMode
                 }
 
+class MiLightGroup(MiLightNode):
+
+    def __init__(self, controller, primary, address, name, members):
+
+        super(MiLightGroup, self).__init__(controller, primary, address, name)
+        self.queryON = False
+        self.members = members
+
+    def start(self):
+        LOGGER.info('%s members: %s', self.name, ', '.join(self.members))
+        self.restoreDrivers()
+
+    def setOn(self, command):
+        self.__send('Turn ON', 'on', 1)
+
+    def setOff(self, command):
+        self.__send('Turn OFF', 'on', 0)
+
+    def setColorID(self, command):
+        self.__send('SetColor', 'color', int(command.get('value')))
+
+    def setColor(self, command):
+        self.__send('SetColor', 'color', colorValue(command.get('value')))
+
+    def setSaturation(self, command):
+        self.__send('setSaturation', 'saturation', int(command.get('value')))
+
+    def setBrightness(self, command):
+        self.__send('setBrightness', 'brightness', int(command.get('value')))
+
+    def setTempColor(self, command):
+        self.__send('setTemperature', 'temperature', whiteTemperature(command.get('value')))
+
+    def setEffect(self, command):
+        self.__send('setDiscoMode', 'effect', int(command.get('value')))
+
+    def setWhiteMode(self, command):
+        self.__send('setWhiteMode', 'white', 1)
+
+    def setNightMode(self, command):
+        self.__send('setNightMode', 'night', 1)
+
+    def __send(self, description, key, value):
+        # Queue the command of every member on its bridge, the bridges then send them in parallel
+        steps = {}
+        for address in self.members:
+            node = self.controller.nodes.get(address)
+            if node is None or not hasattr(node, 'sceneTarget'):
+                LOGGER.warning('%s: unknown member %s', self.name, address)
+                continue
+            try:
+                nodeSteps = compileSteps(node.sceneTarget(), {key: value})
+            except ValueError as ex:
+                LOGGER.debug('%s: skipping %s (%s)', self.name, address, str(ex))
+                continue
+            steps.setdefault(node.bridgeClient, []).extend(nodeSteps)
+
+        reported = set()
+        def onSuccess(driver, driverValue):
+            if driver not in reported:
+                reported.add(driver)
+                self.updateDriver(driver, driverValue)
+        queueSteps(steps, description + ' ' + self.name, onSuccess)
+
+    drivers = [{'driver': 'ST', 'value': 0, 'uom': 78},
+               {'driver': 'GV1', 'value': 0, 'uom': 100},
+               {'driver': 'GV2', 'value': 0, 'uom': 51},
+               {'driver': 'GV3', 'value': 0, 'uom': 51},
+               {'driver': 'GV5', 'value': 1, 'uom': 25},
+               {'driver': 'GV4', 'value': 1, 'uom': 25}]
+
+    initialDrivers = {'ST': 0, 'GV1': 0, 'GV2': 0, 'GV3': 100, 'GV4': 1, 'GV5': 0}
+
+    id = 'MILIGHT_GROUP'
+    commands = {
+                    'DON': setOn,
+                    'DOF': setOff,
+                    "SET_COLOR_ID": setColorID,
+                    "SET_COLOR": setColor,
+                    "SET_SAT": setSaturation,
+                    "SET_BRI": setBrightness,
+                    "CLITEMP": setTempColor,
+                    "SET_EFFECT": setEffect,
+                    "WHITE_MODE": setWhiteMode,
+                    "NIGHT_MODE": setNightMode
+                }
+
 if __name__ == "__main__":
     try:
         polyglot = polyinterface.Interface('MiLightNodeServer')
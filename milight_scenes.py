@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+
+"""
+Scenes of the MiLight NodeServer.
+
+A scene is defined in JSON by its number (the value of the RUN_SCENE command of the controller):
+
+  {"1": {"name": "Evening",
+         "zones": {"bridge1_zone1": {"on": 1, "color": 122, "brightness": 40},
+                   "bridge1_zone2": {"on": 1, "temperature": 35, "brightness": 80},
+                   "bridge2": {"on": 0}}}}
+
+The zones are node addresses, their target state accepts the keys of ZONE_SCENE_ACTIONS (zones) or
+LAMP_SCENE_ACTIONS (bridge lamps) plus "on", "white" and "night". A scene is compiled once into the
+commands of each bridge (their bytes are built and memoized at that time), running it queues them on
+every bridge dispatcher at once so the bridges receive them in parallel.
+"""
+
+import logging
+from MilightWifiBridge import MilightWifiBridge
+from milight_bridges import BridgeCommand, PRIORITY_SCENE
+
+
+LOGGER = logging.getLogger(__name__)
+
+# Milight color of each entry of the color picker (COLOR_SEL) and temperature of each white (TEMP_SEL)
+COLOR_VALUE = [0x85,0xBA,0x7A,0xD9,0x54,0x1E,0xFF,0x3B]
+WHITE_TEMP = [0,8,35,61,100]
+
+def colorValue(entry):
+    """Give the Milight color of a color picker entry (command value, from 1)"""
+    return COLOR_VALUE[int(entry)-1]
+
+def whiteTemperature(entry):
+    """Give the temperature of a white entry (command value, from 1)"""
+    return WHITE_TEMP[int(entry)-1]
+
+class SceneActions(object):
+    """MilightWifiBridge actions a node type supports in a scene
+
+    levels lists (key, action, driver, min, max) in the order the commands are sent.
+    """
+
+    def __init__(self, turnOn, turnOff, white, night, levels):
+        self.turnOn = turnOn
+        self.turnOff = turnOff
+        self.white = white
+        self.night = night
+        self.levels = levels
+
+ZONE_SCENE_ACTIONS = SceneActions('turnOn', 'turnOff', 'setWhiteMode', 'setNightMode',
+                                  (('color', 'setColor', 'GV1', 0, 255),
+                                   ('saturation', 'setSaturation', 'GV2', 0, 100),
+                                   ('temperature', 'setTemperature', 'GV5', 0, 100),
+                                   ('brightness', 'setBrightness', 'GV3', 0, 100),
+                                   ('effect', 'setDiscoMode', 'GV4', 1, 9)))
+
+LAMP_SCENE_ACTIONS = SceneActions('turnOnWifiBridgeLamp', 'turnOffWifiBridgeLamp', 'setWhiteModeBridgeLamp', None,
+                                  (('color', 'setColorBridgeLamp', 'GV1', 0, 255),
+                                   ('brightness', 'setBrightnessBridgeLamp', 'GV3', 0, 100),
+                                   ('effect', 'setDiscoModeBridgeLamp', 'GV4', 1, 9)))
+
+class SceneTarget(object):
+    """Node a scene can drive: its bridge client, zone, supported actions and driver setter (driver, value)"""
+    __slots__ = ('name', 'client', 'zoneId', 'actions', 'setDriver')
+
+    def __init__(self, name, client, zoneId, actions, setDriver):
+        self.name = name
+        self.client = client
+        self.zoneId = zoneId
+        self.actions = actions
+        self.setDriver = setDriver
+
+class Scene(object):
+    """Compiled scene: the commands of each bridge, ready to be queued"""
+
+    def __init__(self, number, name, steps):
+        self.number = number
+        self.name = name
+        self.steps = steps # BridgeClient -> list of (action, value, zoneId, target, driver, driverValue)
+
+    def run(self):
+        """Queue the commands of the scene on every bridge
+
+        return: (bool) Commands queued on every bridge
+        """
+        return queueSteps(self.steps, 'scene ' + self.name, priority=PRIORITY_SCENE)
+
+def queueSteps(steps, label, onSuccess=None, priority=None):
+    """Queue commands on the dispatcher of each bridge, the nodes report their drivers once ACKed
+
+    Keyword arguments:
+      steps -- (dict) BridgeClient -> list of (action, value, zoneId, target, driver, driverValue)
+      label -- (string) Origin of the commands (for the logs)
+      onSuccess -- (function, optional) Called with (driver, driverValue) each time a command is ACKed
+      priority -- (int, optional) Priority class of the commands (see milight_bridges.PRIORITIES)
+
+    return: (bool) Commands queued on every bridge
+    """
+    queued = True
+    for client, clientSteps in steps.items():
+        commands = [BridgeCommand(action, value, zoneId, _reporter(target, driver, driverValue, onSuccess),
+                                  '{} {} {}'.format(label, action, target.name), priority=priority)
+                    for action, value, zoneId, target, driver, driverValue in clientSteps]
+        queued = client.submit(*commands) and queued
+    return queued
+
+def _reporter(target, driver, driverValue, onSuccess):
+    if driver is None:
+        return None
+
+    def report():
+        target.setDriver(driver, driverValue)
+        if onSuccess is not None:
+            onSuccess(driver, driverValue)
+    return report
+
+def compileSteps(target, state):
+    """Give the commands setting a node to a scene state
+
+    Keyword arguments:
+      target -- (SceneTarget) Node to drive
+      state -- (dict) Target state of the node
+
+    return: (list of (action, value, zoneId, target, driver, driverValue))
+
+    Raise ValueError if the state holds an unknown key or a value out of range
+    """
+    actions = target.actions
+    known = set(['on', 'white', 'night'] + [level[0] for level in actions.levels])
+    unknown = set(state) - known
+    if len(unknown) > 0:
+        raise ValueError('unknown setting(s) {} for {}'.format(', '.join(sorted(unknown)), target.name))
+
+    # Any level command turns the bulb on, a zone turned off only gets the OFF command
+    if 'on' in state and not state['on']:
+        return [(actions.turnOff, None, target.zoneId, target, 'ST', 0)]
+
+    steps = []
+    if 'on' in state:
+        steps.append((actions.turnOn, None, target.zoneId, target, 'ST', 100))
+    if state.get('white'):
+        steps.append((actions.white, None, target.zoneId, target, None, None))
+    if state.get('night'):
+        if actions.night is None:
+            raise ValueError('{} has no night mode'.format(target.name))
+        steps.append((actions.night, None, target.zoneId, target, None, None))
+    for key, action, driver, minimum, maximum in actions.levels:
+        if key not in state:
+            continue
+        value = int(state[key])
+        if value < minimum or value > maximum:
+            raise ValueError('{} of {} must be between {} and {}'.format(key, target.name, minimum, maximum))
+        steps.append((action, value, target.zoneId, target, driver, value))
+    return steps
+
+def compileScene(number, definition, targets):
+    """Compile a scene definition into the commands of each bridge
+
+    Keyword arguments:
+      number -- (int) Scene number
+      definition -- (dict) Scene definition (see the module documentation)
+      targets -- (dict) Node address -> SceneTarget
+
+    return: (Scene)
+
+    Raise ValueError if the definition is invalid
+    """
+    name = str(definition.get('name', number))
+    zones = definition.get('zones')
+    if not isinstance(zones, dict) or len(zones) == 0:
+        raise ValueError('scene {} has no zones'.format(name))
+    steps = {}
+    for address, state in sorted(zones.items()):
+        target = targets.get(address)
+        if target is None:
+            raise ValueError('scene {} uses unknown node {}'.format(name, address))
+        if not isinstance(state, dict):
+            raise ValueError('scene {} has an invalid state for {}'.format(name, address))
+        steps.setdefault(target.client, []).extend(compileSteps(target, state))
+    # Build (and memoize) the bridge commands now rather than when the scene runs
+    for clientSteps in steps.values():
+        for step in clientSteps:
+            MilightWifiBridge.getCommand(step[0], step[1])
+    return Scene(number, name, steps)
+
+def compileScenes(definitions, targets):
+    """Compile every valid scene, the invalid ones are logged and skipped
+
+    Keyword arguments:
+      definitions -- (dict) Scene number -> scene definition
+      targets -- (dict) Node address -> SceneTarget
+
+    return: (dict) Scene number (int) -> Scene
+    """
+    scenes = {}
+    for number, definition in definitions.items():
+        try:
+            scene = compileScene(int(number), definition, targets)
+        except (ValueError, TypeError, AttributeError) as ex:
+            LOGGER.error('Invalid scene %s: %s', number, str(ex))
+            continue
+        scenes[scene.number] = scene
+    return scenes